@@ -0,0 +1,995 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from script2game import (Script2Game, Renderer, Item, WorldValidator, Profiler, PlaythroughRunner,
+                         WorldWatcher, load_playthrough)
+from worldgen import generate_world, write_world
+
+
+class SoakGame(Script2Game):
+    # Walks back and forth between the first two rooms of a generated world
+    # without a terminal attached.
+    def __init__(self, world, transitions):
+        super().__init__(world.files, renderer=Renderer())
+        self.rooms = [scene['name'] for scene in world.scenes[:2]]
+        self.transitions = transitions
+        self.commands_sent = 0
+
+    def prompt(self, message):
+        if self.commands_sent >= self.transitions:
+            raise EOFError
+        first, second = self.rooms
+        target = second if self.current_scene == first.lower() else first
+        # Alternate between the 'go to' and the bare exit name forms.
+        self.commands_sent += 1
+        return f"go to {target}" if self.commands_sent % 2 else target
+
+
+def scratch_directory():
+    # Where a benchmark writes its worlds; removed when the with block ends.
+    return tempfile.TemporaryDirectory(prefix='s2g-bench-')
+
+
+def write_sized_world(directory, size):
+    # A generated world cut off after size bytes, mid-scene if need be.
+    with scratch_directory() as sample:
+        per_scene = os.path.getsize(generate_world(sample, scenes=64, combinations=0).files[0]) / 64
+    path = generate_world(directory, scenes=int(size / per_scene) + 1, combinations=0).files[0]
+    os.truncate(path, size)
+    return path
+
+
+def timed(func, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_cache(args):
+    with scratch_directory() as directory:
+        files = generate_world(directory, scenes=args.scenes, files=args.files).files
+        cache_dir = os.path.join(directory, 'cache')
+        cold = timed(lambda: Script2Game(files), args.repeat)
+        Script2Game(files, cache_dir=cache_dir)
+        cached = timed(lambda: Script2Game(files, cache_dir=cache_dir), args.repeat)
+
+        # Touching a file forces a hash check but no re-parse.
+        for path in files:
+            os.utime(path)
+        touched = timed(lambda: Script2Game(files, cache_dir=cache_dir), 1)
+
+        print(f"world: {args.scenes} scenes in {args.files} file(s)")
+        print(f"cold parse:        {cold * 1000:9.2f} ms")
+        print(f"cached load:       {cached * 1000:9.2f} ms  ({cold / cached:.1f}x faster)")
+        print(f"touched (rehash):  {touched * 1000:9.2f} ms")
+
+
+def bench_scaling(args):
+    sizes = []
+    size = 1024
+    while size <= args.max_mb * 1024 * 1024:
+        sizes.append(size)
+        size *= 10
+    engine = Script2Game([])
+    with scratch_directory() as directory:
+        print(f"{'input':>10} {'scenes':>8} {'time':>11} {'throughput':>12} {'peak mem':>10}")
+        for size in sizes:
+            path = write_sized_world(directory, size)
+
+            def consume():
+                # Drop each scene as it is produced to measure the parser alone.
+                count = 0
+                with open(path, encoding='utf-8') as f:
+                    for _ in engine.iter_scenes(f, [], source=path):
+                        count += 1
+                return count
+
+            start = time.perf_counter()
+            count = consume()
+            elapsed = time.perf_counter() - start
+            peak = ''
+            if args.memory and size <= 10 * 1024 * 1024:
+                tracemalloc.start()
+                consume()
+                peak = f"{tracemalloc.get_traced_memory()[1] / 1024:.0f} KiB"
+                tracemalloc.stop()
+            print(f"{size / 1024:>8.0f}KB {count:>8} {elapsed * 1000:>9.2f}ms {size / elapsed / 1e6:>8.1f} MB/s {peak:>10}")
+
+
+def bench_parallel(args):
+    with scratch_directory() as directory:
+        files = generate_world(directory, scenes=args.scenes, files=args.files).files
+        sequential = Script2Game(files)
+        baseline = timed(lambda: Script2Game(files), args.repeat)
+        print(f"world: {len(sequential.scenes)} scenes in {len(files)} files, {os.cpu_count()} CPU(s)")
+        print(f"workers  1: {baseline * 1000:9.2f} ms")
+        for workers in args.workers:
+            engine = Script2Game(files, workers=workers)
+            assert list(engine.scenes) == list(sequential.scenes)
+            elapsed = timed(lambda: Script2Game(files, workers=workers), args.repeat)
+            print(f"workers {workers:>2}: {elapsed * 1000:9.2f} ms  ({baseline / elapsed:.2f}x)")
+
+
+def bench_lazy(args):
+    with scratch_directory() as directory:
+        print(f"{'scenes':>8} {'mode':>6} {'first room':>12} {'traced mem':>12}")
+        scenes = 1000
+        while scenes <= args.scenes:
+            files = generate_world(os.path.join(directory, str(scenes)), scenes=scenes).files
+            for lazy in (False, True):
+                def first_room():
+                    engine = Script2Game(files, lazy=lazy)
+                    engine.scenes[next(iter(engine.scenes))]
+                    return engine
+
+                start = time.perf_counter()
+                engine = first_room()
+                elapsed = time.perf_counter() - start
+                del engine
+                tracemalloc.start()
+                engine = first_room()
+                memory = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+                print(f"{scenes:>8} {'lazy' if lazy else 'eager':>6} {elapsed * 1000:>10.2f}ms {memory / 1024:>9.0f} KiB")
+                if lazy:
+                    engine.scenes.close()
+            scenes *= 10
+
+
+def bench_soak(args):
+    with scratch_directory() as directory:
+        game = SoakGame(generate_world(directory, scenes=2), args.transitions)
+        start = time.perf_counter()
+        game.start_game()
+        elapsed = time.perf_counter() - start
+        print(f"{game.commands_sent} room transitions in {elapsed:.2f}s ({game.commands_sent / elapsed:.0f}/s)")
+
+
+def bench_headless(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes)
+        layout = {scene['name'].lower(): scene for scene in world.scenes}
+        engine = Script2Game(world.files, renderer=Renderer())
+        engine.start()
+        commands = 0
+        output = 0
+        start = time.perf_counter()
+        while commands < args.commands:
+            scene = layout[engine.current_scene]
+            container, item = scene['items'][0][0], scene['items'][1][0]
+            script = ['look', f"look at {container}", f"take {item}", 'inventory', f"drop {item}",
+                      f"talk to {scene['speaker']}", '1', '1', 'e', f"look at {scene['speaker']}",
+                      f"go to {scene['exits'][0]}"]
+            for line in script:
+                output += len(engine.step(line))
+            commands += len(script)
+        elapsed = time.perf_counter() - start
+        print(f"{commands} commands in {elapsed:.2f}s: {commands / elapsed:.0f} commands/s, {output / elapsed / 1e6:.1f} MB/s of output")
+
+
+PROMPT = b'What do you want to do? '
+
+
+async def simulated_player(host, port, player, scenes, commands, think, latencies, connections):
+    async with connections:
+        reader, writer = await asyncio.open_connection(host, port)
+    rng = random.Random(player)
+    try:
+        await reader.readuntil(PROMPT)
+        n = 0
+        for i in range(commands):
+            await asyncio.sleep(rng.uniform(0, 2 * think))
+            item = scenes[n]['items'][1][0]
+            command = ['look', f"take {item}", 'inventory', f"drop {item}", f"go to {scenes[n]['exits'][0]}"][i % 5]
+            start = time.perf_counter()
+            writer.write(command.encode('utf-8') + b'\n')
+            await reader.readuntil(PROMPT)
+            latencies.append(time.perf_counter() - start)
+            if command.startswith('go to'):
+                n = (n + 1) % len(scenes)
+        writer.write(b'quit\n')
+        await reader.read()
+    finally:
+        writer.close()
+
+
+async def run_players(host, port, players, scenes, commands, think):
+    latencies = []
+    # Cap concurrent connects so the listen backlog is not the bottleneck.
+    connections = asyncio.Semaphore(512)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(simulated_player(host, port, player, scenes, commands, think, latencies, connections)
+                                     for player in range(players)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors = [result for result in results if isinstance(result, BaseException)]
+    return sorted(latencies), elapsed, errors
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def bench_server(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'script2game.py')
+        server = subprocess.Popen([sys.executable, script, 'serve', *world.files, '--port', '0', '--no-cache'],
+                                  stdout=subprocess.PIPE, text=True)
+        try:
+            banner = server.stdout.readline()
+            while banner and not banner.startswith('Serving'):
+                banner = server.stdout.readline()
+            host, port = banner.rsplit(' ', 1)[1].strip().rsplit(':', 1)
+            print(banner.strip())
+            print(f"{'players':>8} {'commands':>9} {'p50':>9} {'p99':>9} {'max':>9} {'errors':>7} {'wall':>8}")
+            for players in args.players:
+                latencies, elapsed, errors = asyncio.run(run_players(host, int(port), players, world.scenes,
+                                                                     args.player_commands, args.think))
+                print(f"{players:>8} {len(latencies):>9} {percentile(latencies, 0.5) * 1000:>7.2f}ms "
+                      f"{percentile(latencies, 0.99) * 1000:>7.2f}ms {latencies[-1] * 1000 if latencies else 0:>7.2f}ms "
+                      f"{len(errors):>7} {elapsed:>7.1f}s")
+                if errors:
+                    print(f"  first error: {errors[0]!r}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def bench_sessions(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes)
+        engine = Script2Game(world.files, renderer=Renderer())
+        renderer = Renderer()
+        container, item = world.scenes[0]['items'][0][0], world.scenes[0]['items'][1][0]
+        print(f"world: {len(engine.scenes)} scenes, {args.sessions} sessions")
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = [engine.new_session(renderer) for _ in range(args.sessions)]
+        fresh = tracemalloc.get_traced_memory()[0]
+        for session in sessions:
+            session.start()
+            session.step(f"take {item}")
+            session.step(f"look at {container}")
+        played = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f"new session:                      {(fresh - before) / len(sessions):8.0f} bytes")
+        print(f"after take + reveal in one room:  {(played - before) / len(sessions):8.0f} bytes")
+
+
+def bench_items(args):
+    with scratch_directory() as directory:
+        print(f"{'items':>7} {'take':>9} {'look at':>9} {'use':>9} {'drop':>9}  (per command, room and inventory hold 'items' each)")
+        for items in (10, 1000, 10000):
+            world = generate_world(os.path.join(directory, str(items)), scenes=1, items=2 * items, containers=0,
+                                   characters=0, combinations=0)
+            names = [name for name, _, _ in world.scenes[0]['items']]
+            engine = Script2Game(world.files, renderer=Renderer())
+            engine.start()
+            # Fill the inventory with the first half of the room.
+            for name in names[:items]:
+                engine.step(f"take {name}")
+            timings = {}
+            for verb in ('take', 'look at', 'use', 'drop'):
+                targets = names[items:] if verb in ('take', 'look at') else names[:items]
+                start = time.perf_counter()
+                for target in targets:
+                    engine.step(f"{verb} {target}")
+                timings[verb] = (time.perf_counter() - start) / len(targets)
+            print(f"{items:>7} " + ' '.join(f"{timings[verb] * 1e6:>7.2f}us" for verb in ('take', 'look at', 'use', 'drop')))
+
+
+def bench_dispatch(args):
+    with scratch_directory() as directory:
+        commands = (('exact', 'look at brass lamp {}'), ('suffix', 'take lamp {}'), ('short verb', 'dr lamp {}'),
+                    ('character', 'l at hawker {}'), ('exit prefix', 'alley {} n'), ('plugin', 'chant{} softly'))
+        print(f"{'names':>7} " + ' '.join(f"{label:>12}" for label, _ in commands) + "  (per command; as many verbs, items, characters and exits)")
+        for names in (10, 1000, 10000):
+            # One room with names each of items, characters and exits that
+            # differ only in their numbers, so every name has many near misses.
+            market = {'name': 'Market', 'exits': [f"Alley {i} North" for i in range(names)],
+                      'items': [(f"Brass Lamp {i}", None, False) for i in range(names)],
+                      'characters': [f"Hawker {i}" for i in range(names)], 'speaker': None}
+            world = write_world(os.path.join(directory, str(names)), [market])
+            engine = Script2Game(world.files, renderer=Renderer())
+            for verb_id in range(names):
+                engine.register_command(f"chant{verb_id}", lambda game, argument, scene: game.renderer.write(argument))
+            engine.start()
+            targets = random.Random(0).sample(range(names), min(names, 1000))
+            timings = []
+            for label, template in commands:
+                start = time.perf_counter()
+                for target in targets:
+                    engine.step(template.format(target))
+                timings.append((time.perf_counter() - start) / len(targets))
+            print(f"{names:>7} " + ' '.join(f"{timing * 1e6:>10.2f}us" for timing in timings))
+
+
+def count_dialogue_nodes(roots):
+    seen = set()
+    tree_nodes = 0
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        tree_nodes += 1
+        seen.add(id(node))
+        stack.extend(choice[1] if isinstance(choice, tuple) else choice.node for choice in node.choices)
+    return tree_nodes, len(seen)
+
+
+def bench_dialogue(args):
+    with scratch_directory() as directory:
+        # Every speaker offers a conversation of the same shape, like the
+        # repeated "Ask about his methods" branches of demo.md, so most
+        # subtrees are equal.
+        world = generate_world(directory, scenes=min(args.scenes, 500), items=0, containers=0,
+                               dialogue_depth=4, dialogue_branching=3, combinations=0)
+        speakers = {scene['name'].lower(): scene['speaker'] for scene in world.scenes}
+        gc.collect()
+        tracemalloc.start()
+        engine = Script2Game(world.files, renderer=Renderer())
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        roots = [engine.scenes[key]['content']['Dialogues'][speaker.lower()] for key, speaker in speakers.items()]
+        tree_nodes, stored_nodes = count_dialogue_nodes(roots)
+        print(f"{len(roots)} dialogues, {tree_nodes} nodes as written, {stored_nodes} stored")
+        print(f"world in memory:  {memory / 1024:10.0f} KiB")
+
+        rng = random.Random(0)
+        choices = 0
+        engine.start()
+        start = time.perf_counter()
+        for _ in range(args.commands // 5):
+            engine.step(f"talk to {speakers[engine.current_scene]}")
+            while engine.current_dialogue_node:
+                engine.step(str(rng.randint(1, len(engine.current_dialogue_node.choices))))
+                choices += 1
+        elapsed = time.perf_counter() - start
+        print(f"traversal:        {choices / elapsed:10.0f} choices/s")
+
+
+def bench_crafting(args):
+    with scratch_directory() as directory:
+        rng = random.Random(0)
+        parts = [f"Part {part}" for part in range(args.parts)]
+        recipes = []
+        used = set()
+        for number in range(args.recipes):
+            # One result per ingredient list, so combine never has to ask.
+            ingredients = rng.sample(parts, rng.randint(2, 4))
+            while frozenset(ingredients) in used:
+                ingredients = rng.sample(parts, rng.randint(2, 4))
+            used.add(frozenset(ingredients))
+            recipes.append((ingredients, f"Gadget {number}"))
+        workshop = {'name': 'Workshop', 'exits': [], 'items': [(part, None, False) for part in parts],
+                    'characters': [], 'speaker': None}
+        world = write_world(directory, [workshop], recipes)
+        start = time.perf_counter()
+        engine = Script2Game(world.files, renderer=Renderer())
+        print(f"{len(engine.recipes)} recipes over {args.parts} parts loaded in {time.perf_counter() - start:.2f}s")
+        engine.start()
+        rng = random.Random(1)
+
+        def per_command(commands, undo=None):
+            elapsed = 0.0
+            for command in commands:
+                start = time.perf_counter()
+                engine.step(command)
+                elapsed += time.perf_counter() - start
+                if undo:
+                    undo(command)
+            return elapsed / len(commands) * 1e6
+
+        take = per_command([f"take part {part}" for part in range(args.parts)])
+        craftable = per_command(['craftable'] * 1000)
+        recipes = rng.sample(list(engine.recipes), 1000)
+
+        def restore(command):
+            recipe = recipes[restore.done]
+            restore.done += 1
+            engine.inventory.remove(engine.inventory.find(recipe.result))
+            for name in recipe.ingredients:
+                engine.inventory.add(Item(name))
+        restore.done = 0
+        combine = per_command([f"combine {' + '.join(recipe.ingredients)}" for recipe in recipes], restore)
+        restore.done = 0
+        craft = per_command([f"craft {recipe.result}" for recipe in recipes], restore)
+        drop = per_command([f"drop part {part}" for part in range(args.parts)])
+        print(f"inventory of {args.parts} parts, {len(engine.recipes)} recipes craftable at the peak")
+        for label, timing in (('take', take), ('craftable', craftable), ('combine', combine), ('craft', craft), ('drop', drop)):
+            print(f"{label:<10} {timing:8.1f}us per command")
+        assert not engine.inventory.craftable and not engine.inventory.progress
+
+
+def journal_moves(world, moves):
+    # Walks round the generated world, carrying one item along, revealing
+    # and pocketing each room's hidden note.
+    made = 0
+    carried = None
+    while True:
+        for scene in world.scenes:
+            (container, note, _), (item, _, _) = scene['items'][:2]
+            commands = [f"take {item}", f"look at {container}", f"take {note}", f"go to {scene['exits'][0]}"]
+            if carried:
+                commands.insert(0, f"drop {carried}")
+            for command in commands:
+                if made == moves:
+                    return
+                yield command
+                made += 1
+            carried = item
+
+
+def resume(engine, path):
+    session = engine.new_session()
+    start = time.perf_counter()
+    session.open_save(path)
+    elapsed = time.perf_counter() - start
+    session.journal.close()
+    return session, elapsed
+
+
+def bench_journal(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes)
+        engine = Script2Game(world.files, renderer=Renderer())
+        print(f"world: {len(engine.scenes)} scenes, {args.moves} moves")
+
+        plain = engine.new_session()
+        plain.start()
+        start = time.perf_counter()
+        for command in journal_moves(world, args.moves):
+            plain.step(command)
+        unsaved = time.perf_counter() - start
+
+        save = os.path.join(directory, 'save')
+        session = engine.new_session()
+        session.open_save(save)
+        session.start()
+        start = time.perf_counter()
+        for command in journal_moves(world, args.moves):
+            session.step(command)
+        saved = time.perf_counter() - start
+        print(f"play without saving:  {unsaved / args.moves * 1e6:8.1f}us per move")
+        print(f"play with journal:    {saved / args.moves * 1e6:8.1f}us per move")
+
+        # Stop just before the next compaction: the longest replay there is.
+        extra = journal_moves(world, 10 ** 9)
+        while session.journal.entries < session.journal.compact_every - 1:
+            session.step(next(extra))
+        session.journal.close()
+        snapshot_size = os.path.getsize(os.path.join(save, 'snapshot.json'))
+        journal_size = os.path.getsize(os.path.join(save, 'journal.jsonl'))
+        print(f"on disk:              {snapshot_size / 1024:8.1f} KiB snapshot + {journal_size / 1024:.1f} KiB journal")
+        resumed, elapsed = resume(engine, save)
+        print(f"resume:               {elapsed * 1000:8.1f}ms (snapshot + {resumed.journal.entries} journal lines)")
+        compacted = os.path.join(directory, 'compacted')
+        shutil.copytree(save, compacted)
+        resumed, _ = resume(engine, compacted)
+        resumed.journal.open()
+        start = time.perf_counter()
+        resumed.close_save()
+        print(f"compaction:           {(time.perf_counter() - start) * 1000:8.1f}ms")
+        resumed, elapsed = resume(engine, compacted)
+        print(f"resume from snapshot: {elapsed * 1000:8.1f}ms")
+
+
+def bench_validate(args):
+    with scratch_directory() as directory:
+        print(f"{'scenes':>7} {'load':>9} {'validate':>9} {'per scene':>10} {'problems':>9}")
+        for scenes in sorted({args.scenes // 10, args.scenes // 2, args.scenes}):
+            world = generate_world(os.path.join(directory, str(scenes)), scenes=scenes)
+            start = time.perf_counter()
+            engine = Script2Game(world.files, renderer=Renderer())
+            loaded = time.perf_counter() - start
+            start = time.perf_counter()
+            problems = WorldValidator(engine).run()
+            elapsed = time.perf_counter() - start
+            print(f"{scenes:>7} {loaded:>8.2f}s {elapsed:>8.2f}s {elapsed / scenes * 1e6:>8.1f}us {len(problems):>9}")
+            assert not problems, problems[:5]
+
+
+def bench_profile(args):
+    # The same walk through a generated world with no profiler, with one and
+    # with allocation tracing too; the first line is the cost everybody pays.
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes, files=args.files)
+        moves = list(journal_moves(world, args.moves))
+        for label, make in (('disabled', lambda: None), ('enabled', Profiler),
+                            ('allocations', lambda: Profiler(allocations=True))):
+            profiler = make()
+            start = time.perf_counter()
+            engine = Script2Game(world.files, renderer=Renderer(), profiler=profiler)
+            load = time.perf_counter() - start
+            engine.start()
+            start = time.perf_counter()
+            for move in moves:
+                engine.step(move)
+            per_command = (time.perf_counter() - start) / len(moves)
+            print(f"{label:>12}: load {load:.3f}s, {per_command * 1e6:.2f}us per command")
+            if profiler is not None:
+                profiler.export(os.path.join(directory, 'profile.json'))
+            tracemalloc.stop()
+
+
+def write_playthrough(path, world, length, rng):
+    # A random walk through a generated world: look around, pick up what can
+    # be taken, have a chat in every other room, then follow an exit, checking
+    # where the player ends up.
+    layout = {scene['name'].lower(): scene for scene in world.scenes}
+    scene = world.scenes[rng.randrange(len(world.scenes))]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"@start {scene['name']}\n")
+        for move in range(length):
+            f.write("look\n")
+            item, _, fixed = rng.choice(scene['items'])
+            if not fixed:
+                f.write(f"take {item}\n@has {item}\ndrop {item}\n@lacks {item}\n")
+            if scene['speaker'] and move % 2:
+                f.write(f"talk to {scene['speaker']}\n1\ne\n")
+            scene = layout[rng.choice(scene['exits']).lower()]
+            f.write(f"go to {scene['name']}\n@scene {scene['name']}\n~ __{scene['name']}__\n")
+
+
+def bench_playthroughs(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes, files=args.files, fixed=1, seed=args.seed)
+        rng = random.Random(args.seed)
+        playthroughs = []
+        for number in range(args.samples):
+            path = os.path.join(directory, f"walk_{number:05d}.play")
+            write_playthrough(path, world, 50, rng)
+            playthroughs.append(load_playthrough(path))
+        print(f"world: {args.scenes} scenes, {len(playthroughs)} playthroughs of 50 rooms each")
+        for workers in [1] + args.workers:
+            start = time.perf_counter()
+            results = PlaythroughRunner(world.files, workers=workers).run(playthroughs)
+            elapsed = time.perf_counter() - start
+            failed = sum(1 for result in results if result['failures'])
+            commands = sum(result['commands'] for result in results)
+            print(f"{workers:>2} worker(s): {elapsed:.2f}s, {commands / elapsed:,.0f} commands/s, {failed} failed")
+            assert not failed, next(result['failures'] for result in results if result['failures'])
+
+
+def bench_reload(args):
+    # Edits one scene's description in a world of one big file and in one
+    # of many small files, while a player carries an item through it.
+    with scratch_directory() as directory:
+        print(f"{'files':>6} {'full load':>10} {'reload':>10}  (one scene edited in a {args.scenes} scene world)")
+        for files in (1, 100):
+            world = generate_world(os.path.join(directory, str(files)), scenes=args.scenes, files=files, seed=args.seed)
+            start = time.perf_counter()
+            engine = Script2Game(world.files, renderer=Renderer())
+            load = time.perf_counter() - start
+            watcher = WorldWatcher(engine, world.files)
+            session = engine.new_session()
+            scene = world.scenes[len(world.scenes) // 2]
+            session.start(scene['name'])
+            item = next(name for name, _, fixed in scene['items'] if not fixed)
+            session.step(f"take {item}")
+            path = world.files[(len(world.scenes) // 2) * files // len(world.scenes)]
+            timings = []
+            for edit in range(args.repeat):
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text.replace(f"## Scene: {scene['name']}\n\n### Description\n\n",
+                                         f"## Scene: {scene['name']}\n\n### Description\n\nEdit {edit}.\n", 1))
+                start = time.perf_counter()
+                reloaded = watcher.poll(force=True)
+                timings.append(time.perf_counter() - start)
+                assert reloaded == [path], reloaded
+                assert f"Edit {edit}." in session.step('look'), "the edit did not show up"
+                assert session.inventory.find(item), "the carried item was lost"
+            print(f"{files:>6} {load * 1e3:>8.1f}ms {min(timings) * 1e3:>8.2f}ms")
+        check_reload_with_ingredients(directory)
+        print("reload checks: held ingredients across recipe edits, a save with no scenes: consistent")
+
+
+def check_reload_with_ingredients(directory):
+    # The player holds both ingredients of a recipe while the scene they came
+    # from and the recipe itself are edited in one save.
+    path = os.path.join(directory, 'workshop.md')
+    scene = "## Scene: Workshop\n\n### Description\n\n{}\n\n### Items\n\n- Lamp\n- Coin\n- Box\n\n"
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(scene.format("A bench.") + "## Global Item Combinations\n- Lamp + Coin = Lantern\n")
+    engine = Script2Game([path], renderer=Renderer())
+    watcher = WorldWatcher(engine, [path])
+    session = engine.new_session()
+    session.start()
+    session.step('take lamp')
+    session.step('take coin')
+    assert [recipe.result for recipe in session.inventory.craftable] == ['Lantern']
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(scene.format("A cluttered bench.") + "## Global Item Combinations\n- Lamp + Coin = Beacon\n"
+                "- Lamp + Box = Lamp Box\n")
+    assert watcher.poll(force=True) == [path]
+    assert [recipe.result for recipe in session.inventory.craftable] == ['Beacon']
+    assert session.inventory.progress, "the held Lamp does not count towards Lamp Box"
+    session.step('take box')
+    assert sorted(recipe.result for recipe in session.inventory.craftable) == ['Beacon', 'Lamp Box']
+    assert 'Beacon' in session.step('craft beacon')
+    assert session.inventory.find('Beacon') and not session.inventory.find('Lamp')
+
+    # Half way through a rewrite the only file has no scenes left: the world
+    # keeps the old ones until a later save brings scenes back.
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# Chapter one, rewritten soon\n")
+    assert watcher.poll(force=True) == []
+    assert session.scene_text(engine.scenes['workshop'])[0] == "A cluttered bench."
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(scene.format("An empty bench.") + "## Global Item Combinations\n- Lamp + Coin = Beacon\n")
+    assert watcher.poll(force=True) == [path]
+    assert session.scene_text(engine.scenes['workshop'])[0] == "An empty bench."
+
+
+def bench_render(args):
+    # look and walking between two rooms in a world of richly furnished
+    # scenes, for a player who has not touched the rooms and for one who
+    # dropped something in each, then many sessions each with a changed room.
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes, items=40, containers=10, characters=6, seed=args.seed)
+        engine = Script2Game(world.files, renderer=Renderer())
+        first, second = world.scenes[0]['name'], world.scenes[1]['name']
+        for label, touched in (('untouched rooms', False), ('changed rooms', True)):
+            session = engine.new_session()
+            session.start(first)
+            if touched:
+                for room in (second, first):
+                    session.step('take hidden note')
+                    session.step(f"go to {room}")
+                    session.step('drop note')
+            looks = timed(lambda: [session.step('look') for _ in range(10000)], args.repeat) / 10000
+            walks = timed(lambda: [session.step(f"go to {room}") for room in (second, first) * 5000], args.repeat) / 10000
+            print(f"{label:>16}: look {looks * 1e6:.2f}us, re-entry {walks * 1e6:.2f}us")
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = []
+        for number in range(args.sessions):
+            session = engine.new_session()
+            session.start(world.scenes[number % len(world.scenes)]['name'])
+            session.step(f"take {world.scenes[number % len(world.scenes)]['items'][0][0]}")
+            session.step('look')
+            sessions.append(session)
+        per_session = (tracemalloc.get_traced_memory()[0] - before) / len(sessions)
+        tracemalloc.stop()
+        print(f"{args.sessions} sessions that each changed a room: {per_session:.0f} bytes per session, "
+              f"{len(engine.rendered_scenes)} scenes formatted")
+
+        # A session that looked inside a container formats the shared text of
+        # its room again: the other sessions still see the container closed.
+        room = world.scenes[2]
+        session = engine.new_session()
+        session.start(room['name'])
+        session.step(f"look at {room['items'][1][0]}")
+        engine.rendered_scenes.pop(room['name'].lower())
+        assert 'Inside, you see' in session.step('look')
+        assert 'Inside, you see' not in engine.new_session().start(room['name'])
+        print("shared scene text: one session's reveals stay its own")
+
+
+def shortest_distance(engine, source, target):
+    # Plain breadth-first search over the scene dicts, to check routes against.
+    seen = {source: 0}
+    queue = [source]
+    for key in queue:
+        if key == target:
+            return seen[key]
+        for exit in engine.scenes[key]['content'].get('Exits', ()):
+            if exit.lower() in engine.scenes and exit.lower() not in seen:
+                seen[exit.lower()] = seen[key] + 1
+                queue.append(exit.lower())
+    return None
+
+
+def bench_routing(args):
+    with scratch_directory() as directory:
+        world = generate_world(directory, scenes=args.scenes, exits=3, items=1, containers=0, characters=0,
+                               combinations=0, seed=args.seed)
+        engine = Script2Game(world.files, renderer=Renderer())
+        graph = engine.scene_graph
+        build = timed(graph.build, args.repeat)
+        gc.collect()
+        tracemalloc.start()
+        graph.build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"graph: {len(graph.keys)} scenes, {len(graph.targets)} exits, built in {build * 1e3:.1f}ms, "
+              f"{size / 1e6:.1f}MB traced")
+
+        rng = random.Random(args.seed)
+        keys = list(engine.scenes)
+        destinations = rng.sample(keys, 10)
+        start = time.perf_counter()
+        for destination in destinations:
+            graph.next_steps(graph.ids[destination])
+        search = (time.perf_counter() - start) / len(destinations)
+        pairs = [(rng.choice(keys), rng.choice(destinations)) for _ in range(10000)]
+        start = time.perf_counter()
+        routes = [graph.route(source, target) for source, target in pairs]
+        cached = (time.perf_counter() - start) / len(pairs)
+        hops = sum(len(route) for route in routes if route) / max(1, sum(1 for route in routes if route))
+        print(f"route: {search * 1e3:.1f}ms per new destination, {cached * 1e6:.1f}us cached ({hops:.1f} steps on average)")
+        for source, target in pairs[:20]:
+            route = graph.route(source, target)
+            assert (len(route) if route is not None else None) == shortest_distance(engine, source, target)
+
+        session = engine.new_session()
+        session.start()
+        commands = [f"travel to {engine.scenes[target]['name']}" for _, target in pairs[:2000]]
+        start = time.perf_counter()
+        for command in commands:
+            session.step(command)
+        travel = (time.perf_counter() - start) / len(commands)
+        assert session.current_scene == pairs[1999][1]
+        print(f"travel to: {travel * 1e6:.1f}us per command")
+
+
+def suite_setups(world, session, rng):
+    # For each verb, a function that prepares the session untimed and
+    # returns (command, undo): command is the line to time and undo puts the
+    # session back afterwards so samples do not drift.
+    def scene():
+        layout = world.scenes[rng.randrange(len(world.scenes))]
+        session.current_scene = layout['name'].lower()
+        session.current_dialogue_node = None
+        return layout
+
+    def movable(layout):
+        return [item for item, _, fixed in layout['items'] if not fixed] or [None]
+
+    def carried(command):
+        def setup():
+            item = rng.choice(movable(scene()))
+            session.step(f"take {item}")
+            return f"{command} {item}", lambda: session.step(f"drop {item}")
+        return setup
+
+    def take():
+        item = rng.choice(movable(scene()))
+        return f"take {item}", lambda: session.step(f"drop {item}")
+
+    def drop():
+        item = rng.choice(movable(scene()))
+        session.step(f"take {item}")
+        return f"drop {item}", None
+
+    def holding(ingredients, result=None):
+        items = [Item(name) for name in ingredients]
+        for item in items:
+            session.add_to_inventory(item)
+
+        def undo():
+            for item in items:
+                if item in session.inventory:
+                    session.remove_from_inventory(item)
+            made = result and session.inventory.find(result)
+            if made:
+                session.remove_from_inventory(made)
+        return undo
+
+    def combine():
+        ingredients, result = rng.choice(world.recipes)
+        return f"combine {' + '.join(ingredients)}", holding(ingredients, result)
+
+    def craft():
+        ingredients, result = rng.choice(world.recipes)
+        return f"craft {result}", holding(ingredients, result)
+
+    def craftable():
+        ingredients, _ = rng.choice(world.recipes)
+        return "craftable", holding(ingredients)
+
+    def talk():
+        return f"talk to {scene()['speaker']}", lambda: session.step('e')
+
+    def choose():
+        session.step(f"talk to {scene()['speaker']}")
+        return "1", lambda: session.current_dialogue_node and session.step('e')
+
+    setups = {
+        'look': lambda: (scene() and 'look', None),
+        'look at': lambda: (f"look at {rng.choice(scene()['items'])[0]}", None),
+        'inventory': lambda: (scene() and 'inventory', None),
+        'take': take,
+        'drop': drop,
+        'use': carried('use'),
+        'give': carried('give'),
+        'talk to': talk,
+        'dialogue choice': choose,
+        'go to': lambda: (f"go to {rng.choice(scene()['exits'])}", None),
+        'exit': lambda: (rng.choice(scene()['exits']), None),
+    }
+    if world.recipes:
+        setups.update({'combine': combine, 'craft': craft, 'craftable': craftable})
+    return setups
+
+
+def metric(value, unit, better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def run_suite(args):
+    with scratch_directory() as directory:
+        config = {'scenes': args.scenes, 'files': args.files, 'seed': args.seed, 'samples': args.samples}
+        world = generate_world(directory, scenes=args.scenes, files=args.files, items=4, containers=1, fixed=1,
+                               characters=2, dialogue_depth=3, dialogue_branching=3,
+                               combinations=max(10, args.scenes // 10), seed=args.seed)
+        size = sum(os.path.getsize(path) for path in world.files)
+        metrics = {}
+
+        load = timed(lambda: Script2Game(world.files, renderer=Renderer()), args.repeat)
+        metrics['load.seconds'] = metric(load, 's')
+        metrics['load.throughput'] = metric(size / load / 1e6, 'MB/s', 'higher')
+        gc.collect()
+        tracemalloc.start()
+        engine = Script2Game(world.files, renderer=Renderer())
+        metrics['memory.world'] = metric(tracemalloc.get_traced_memory()[0], 'bytes')
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = [engine.new_session() for _ in range(1000)]
+        metrics['memory.session'] = metric((tracemalloc.get_traced_memory()[0] - before) / len(sessions), 'bytes')
+        tracemalloc.stop()
+        del sessions
+
+        session = engine.new_session()
+        session.start()
+        rng = random.Random(args.seed)
+        for verb, setup in suite_setups(world, session, rng).items():
+            timings = []
+            for _ in range(args.samples):
+                command, undo = setup()
+                start = time.perf_counter()
+                session.step(command)
+                timings.append(time.perf_counter() - start)
+                if undo:
+                    undo()
+                session.renderer.flush()
+            timings.sort()
+            metrics[f"command.{verb}.mean"] = metric(sum(timings) / len(timings) * 1e6, 'us')
+            metrics[f"command.{verb}.p99"] = metric(percentile(timings, 0.99) * 1e6, 'us')
+
+        choices = 0
+        start = time.perf_counter()
+        for _ in range(args.samples):
+            layout = world.scenes[rng.randrange(len(world.scenes))]
+            session.current_scene = layout['name'].lower()
+            session.step(f"talk to {layout['speaker']}")
+            while session.current_dialogue_node:
+                session.step(str(rng.randint(1, len(session.current_dialogue_node.choices))))
+                choices += 1
+        metrics['dialogue.traversal'] = metric(choices / (time.perf_counter() - start), 'choices/s', 'higher')
+        return {'config': config, 'environment': environment(), 'metrics': metrics}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare_results(baseline, results, threshold):
+    # Prints every metric against the baseline and returns the names of
+    # those that got worse by more than threshold (a fraction).
+    if baseline.get('config') != results.get('config'):
+        print(f"warning: comparing different configurations {baseline.get('config')} and {results.get('config')}")
+    regressions = []
+    print(f"{'metric':<28} {'baseline':>12} {'now':>12} {'change':>8}")
+    for name, now in results['metrics'].items():
+        before = baseline['metrics'].get(name)
+        if before is None or not before['value']:
+            print(f"{name:<28} {'-':>12} {now['value']:>12.2f} {'new':>8}")
+            continue
+        change = now['value'] / before['value'] - 1
+        worse = change > threshold if now['better'] == 'lower' else change < -threshold
+        if worse:
+            regressions.append(name)
+        print(f"{name:<28} {before['value']:>12.2f} {now['value']:>12.2f} {change:>+7.0%}{'  !' if worse else ''}")
+    return regressions
+
+
+def bench_suite(args):
+    results = run_suite(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+        return 0
+    for name, entry in results['metrics'].items():
+        print(f"{name:<28} {entry['value']:>12.2f} {entry['unit']}")
+    return 0
+
+
+def bench_compare(args):
+    if not (args.baseline and args.results):
+        print("compare needs --baseline and --results")
+        return 2
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.results, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    return 1 if compare_results(baseline, results, args.threshold) else 0
+
+
+BENCHMARKS = {
+    'cache': bench_cache,
+    'scaling': bench_scaling,
+    'parallel': bench_parallel,
+    'lazy': bench_lazy,
+    'soak': bench_soak,
+    'headless': bench_headless,
+    'server': bench_server,
+    'sessions': bench_sessions,
+    'items': bench_items,
+    'dispatch': bench_dispatch,
+    'dialogue': bench_dialogue,
+    'crafting': bench_crafting,
+    'journal': bench_journal,
+    'validate': bench_validate,
+    'playthroughs': bench_playthroughs,
+    'profile': bench_profile,
+    'reload': bench_reload,
+    'render': bench_render,
+    'routing': bench_routing,
+    'suite': bench_suite,
+    'compare': bench_compare,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='script2game benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--scenes', type=int, default=2000)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8], help='worker counts for the parallel benchmark')
+    parser.add_argument('--sessions', type=int, default=10000, help='sessions for the per-session overhead benchmark')
+    parser.add_argument('--players', type=int, nargs='+', default=[1000, 10000], help='simulated players for the server benchmark')
+    parser.add_argument('--player-commands', type=int, default=10, help='commands each simulated player sends')
+    parser.add_argument('--think', type=float, default=0.5, help='mean seconds a simulated player waits between commands')
+    parser.add_argument('--commands', type=int, default=200000, help='commands for the headless benchmark')
+    parser.add_argument('--transitions', type=int, default=1000000, help='room changes for the soak benchmark')
+    parser.add_argument('--recipes', type=int, default=100000, help='recipes for the crafting benchmark')
+    parser.add_argument('--parts', type=int, default=5000, help='distinct ingredients (and inventory size) for the crafting benchmark')
+    parser.add_argument('--moves', type=int, default=100000, help='player moves for the journal benchmark')
+    parser.add_argument('--max-mb', type=int, default=100, help='largest input for the scaling benchmark')
+    parser.add_argument('--memory', action='store_true', help='also measure peak parser memory (slower)')
+    parser.add_argument('--seed', type=int, default=0, help='world generator seed for the suite')
+    parser.add_argument('--samples', type=int, default=1000, help='timed samples per command in the suite')
+    parser.add_argument('--output', help='write suite results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare the suite (or --results) against')
+    parser.add_argument('--results', help='JSON results to compare with --baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='slowdown that counts as a regression')
+    args = parser.parse_args(argv)
+    return BENCHMARKS[args.benchmark](args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,100 +2,1411 @@ import os
 import time
 import sys
 import re
-from collections import defaultdict
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import pickle
+import mmap
+import tracemalloc
+import weakref
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from collections.abc import Mapping
+from types import MappingProxyType
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+
+CACHE_VERSION = 7
+JOURNAL_VERSION = 1
+# Per user, so a game folder cannot bring along compiled entries of its own.
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                 'script2game')
+
+class Item:
+    __slots__ = ('name', 'key', 'contains', 'movable', 'description')
+
+    def __init__(self, name, contains=None, movable=True, description=None):
+        self.name = name
+        self.key = name.casefold()
+        self.contains = contains
+        self.movable = movable
+        self.description = description
+
+    def __repr__(self):
+        return f"Item({self.name!r})"
+
+NAME_TIERS = ('exact', 'suffix', 'prefix')
+MAX_CANDIDATES = 10
+MAX_LISTED = 20
+
+class NameIndex:
+    # Case-folded names a player can refer to something by. Besides the full
+    # name, a name matches by its trailing words ("revolver" for "Old Army
+    # Revolver") and by any prefix ("mag" for "Magnifying Glass"). Suffixes
+    # go through a last-word index and prefixes through a sorted key list, so
+    # a lookup costs the same however many names are indexed.
+    __slots__ = ('names', 'last_words', 'keys')
+
+    def __init__(self, names=()):
+        self.names = {}
+        self.last_words = {}
+        self.keys = []
+        for key, name in names:
+            self.add(key, name)
+
+    def add(self, key, name):
+        if key in self.names:
+            return
+        self.names[key] = name
+        self.last_words.setdefault(key.rpartition(' ')[2], {})[key] = None
+        insort(self.keys, key)
+
+    def remove(self, key):
+        del self.names[key]
+        word = key.rpartition(' ')[2]
+        bucket = self.last_words[word]
+        del bucket[key]
+        if not bucket:
+            del self.last_words[word]
+        del self.keys[bisect_left(self.keys, key)]
+
+    def match(self, query, tier):
+        # At most MAX_CANDIDATES keys matching query in the given tier.
+        if tier == 'exact':
+            return [query] if query in self.names else []
+        matches = []
+        if tier == 'suffix':
+            suffix = ' ' + query
+            for key in self.last_words.get(query.rpartition(' ')[2], ()):
+                if key.endswith(suffix):
+                    matches.append(key)
+                    if len(matches) == MAX_CANDIDATES:
+                        break
+            return matches
+        i = bisect_left(self.keys, query)
+        while i < len(self.keys) and len(matches) < MAX_CANDIDATES and self.keys[i].startswith(query):
+            if self.keys[i] != query:
+                matches.append(self.keys[i])
+            i += 1
+        return matches
+
+    def display(self, key):
+        return self.names[key]
+
+    def __len__(self):
+        return len(self.names)
+
+EMPTY_NAMES = NameIndex()
+
+class ItemStore:
+    # Items in insertion order plus an index from case-folded name to the
+    # items carrying it, so lookups, adds and removes are O(1) however many
+    # items a room or inventory holds. Items are compared by identity, so
+    # several items with the same name can be stored side by side. The
+    # NameIndex for partial names is only built once someone needs it.
+    __slots__ = ('items', 'index', 'names')
+
+    def __init__(self, items=()):
+        self.items = {}
+        self.index = {}
+        self.names = None
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        self.items[item] = None
+        bucket = self.index.get(item.key)
+        if bucket is None:
+            bucket = self.index[item.key] = {}
+            if self.names is not None:
+                self.names.add(item.key, item.name)
+        bucket[item] = None
+
+    def remove(self, item):
+        del self.items[item]
+        bucket = self.index[item.key]
+        del bucket[item]
+        if not bucket:
+            del self.index[item.key]
+            if self.names is not None:
+                self.names.remove(item.key)
+
+    def find(self, name):
+        bucket = self.index.get(name.casefold())
+        return next(iter(bucket)) if bucket else None
+
+    def find_all(self, name):
+        return list(self.index.get(name.casefold(), ()))
+
+    def match(self, query, tier):
+        if tier == 'exact':
+            return [query] if query in self.index else []
+        if self.names is None:
+            self.names = NameIndex((key, next(iter(bucket)).name) for key, bucket in self.index.items())
+        return self.names.match(query, tier)
+
+    def display(self, key):
+        return self.find(key).name
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+class ItemOverlay:
+    # A session's changes to a scene's read-only ItemStore: items removed from
+    # the base plus an ItemStore of items added since. Same interface as
+    # ItemStore, and it costs memory only for what changed.
+    __slots__ = ('base', 'removed', 'added')
+
+    def __init__(self, base):
+        self.base = base
+        self.removed = set()
+        self.added = ItemStore()
+
+    def add(self, item):
+        self.added.add(item)
+
+    def remove(self, item):
+        if item in self.added:
+            self.added.remove(item)
+        else:
+            self.removed.add(item)
+
+    def find(self, name):
+        bucket = self.base.index.get(name.casefold())
+        if bucket:
+            for item in bucket:
+                if item not in self.removed:
+                    return item
+        return self.added.find(name)
+
+    def find_all(self, name):
+        return [item for item in self.base.find_all(name) if item not in self.removed] + self.added.find_all(name)
+
+    def match(self, query, tier):
+        keys = [key for key in self.base.match(query, tier) if self.find(key)]
+        keys.extend(key for key in self.added.match(query, tier) if key not in keys)
+        return keys
+
+    def display(self, key):
+        return self.find(key).name
+
+    def __contains__(self, item):
+        return item in self.added or (item in self.base and item not in self.removed)
+
+    def __iter__(self):
+        for item in self.base:
+            if item not in self.removed:
+                yield item
+        yield from self.added
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + len(self.added)
+
+EMPTY_ITEMS = ItemStore()
+
+class Recipe:
+    # ingredients as written; key is the sorted case-folded ingredient names
+    # (repeats kept) and needs counts how many of each name it takes.
+    __slots__ = ('ingredients', 'key', 'needs', 'result', 'description', 'location')
+
+    def __init__(self, ingredients, result, description=None, location=None):
+        self.ingredients = tuple(ingredients)
+        self.key = tuple(sorted(name.casefold() for name in self.ingredients))
+        self.needs = {}
+        for name in self.key:
+            self.needs[name] = self.needs.get(name, 0) + 1
+        self.result = result
+        self.description = description
+        self.location = location
+
+    def __repr__(self):
+        return f"Recipe({' + '.join(self.ingredients)} = {self.result})"
+
+class RecipeBook:
+    # Every recipe of the world, indexed by its full ingredient list (for
+    # combine), by each ingredient (to update craftable sets as inventories
+    # change) and by result name (for craft). Result names resolve like
+    # items through a NameIndex built on first use. recipes maps each recipe
+    # to how many times the world defines it, so a reload can drop one copy.
+    def __init__(self):
+        self.recipes = {}
+        self.by_ingredients = {}
+        self.by_ingredient = {}
+        self.by_result = {}
+        self.names = None
+
+    def stored(self, recipe):
+        for other in self.by_ingredients.get(recipe.key, ()):
+            if other.result == recipe.result and other.description == recipe.description:
+                return other
+        return None
+
+    def add(self, recipe):
+        # Returns True if the recipe is new to the book. The same recipe from
+        # another file is not a second choice, only another copy.
+        other = self.stored(recipe)
+        if other is not None:
+            self.recipes[other] += 1
+            return False
+        self.by_ingredients.setdefault(recipe.key, []).append(recipe)
+        self.recipes[recipe] = 1
+        for name in recipe.needs:
+            self.by_ingredient.setdefault(name, []).append(recipe)
+        result = recipe.result.casefold()
+        self.by_result.setdefault(result, []).append(recipe)
+        if self.names is not None:
+            self.names.add(result, recipe.result)
+        return True
+
+    def remove(self, recipe):
+        # Drops one copy of recipe. Returns the stored recipe when that was
+        # the last copy and it left the book, None otherwise.
+        stored = self.stored(recipe)
+        if stored is None:
+            return None
+        self.recipes[stored] -= 1
+        if self.recipes[stored]:
+            return None
+        del self.recipes[stored]
+        self.unlist(self.by_ingredients, stored.key, stored)
+        for name in stored.needs:
+            self.unlist(self.by_ingredient, name, stored)
+        result = stored.result.casefold()
+        if not self.unlist(self.by_result, result, stored) and self.names is not None:
+            self.names.remove(result)
+        return stored
+
+    def unlist(self, index, key, recipe):
+        recipes = index[key]
+        recipes.remove(recipe)
+        if not recipes:
+            del index[key]
+        return recipes
+
+    def find(self, key):
+        return self.by_ingredients.get(key, ())
+
+    def using(self, name):
+        return self.by_ingredient.get(name, ())
+
+    def producing(self, name):
+        return self.by_result.get(name.casefold(), ())
+
+    def match(self, query, tier):
+        if tier == 'exact':
+            return [query] if query in self.by_result else []
+        if self.names is None:
+            self.names = NameIndex((key, recipes[0].result) for key, recipes in self.by_result.items())
+        return self.names.match(query, tier)
+
+    def display(self, key):
+        return self.by_result[key][0].result
+
+    def __iter__(self):
+        return iter(self.recipes)
+
+    def __len__(self):
+        return len(self.recipes)
+
+class Inventory(ItemStore):
+    # The player's items plus the recipes they can make right now. Each add
+    # or remove only revisits the recipes using that item: progress counts,
+    # per recipe, the ingredient names held in sufficient number, and a
+    # recipe is craftable once all of them are.
+    __slots__ = ('recipes', 'progress', 'craftable')
+
+    def __init__(self, recipes, items=()):
+        self.recipes = recipes
+        self.progress = {}
+        self.craftable = {}
+        super().__init__(items)
+
+    def add(self, item):
+        held = len(self.index.get(item.key, ()))
+        super().add(item)
+        self.update_recipes(item.key, held, held + 1)
+
+    def remove(self, item):
+        held = len(self.index[item.key])
+        super().remove(item)
+        self.update_recipes(item.key, held, held - 1)
+
+    def update_recipes(self, name, before, after):
+        for recipe in self.recipes.using(name):
+            needed = recipe.needs[name]
+            if before < needed <= after:
+                met = self.progress.get(recipe, 0) + 1
+            elif after < needed <= before:
+                met = self.progress[recipe] - 1
+            else:
+                continue
+            if met:
+                self.progress[recipe] = met
+            else:
+                del self.progress[recipe]
+            if met == len(recipe.needs):
+                self.craftable[recipe] = None
+            else:
+                self.craftable.pop(recipe, None)
+
+    def track(self, recipe):
+        # A recipe added to the book after this inventory was filled.
+        met = sum(1 for name, needed in recipe.needs.items() if len(self.index.get(name, ())) >= needed)
+        if met:
+            self.progress[recipe] = met
+        if met == len(recipe.needs):
+            self.craftable[recipe] = None
+
+    def untrack(self, recipe):
+        self.progress.pop(recipe, None)
+        self.craftable.pop(recipe, None)
+
+class CommandNode:
+    __slots__ = ('children', 'prefixes', 'handler')
+
+    def __init__(self):
+        self.children = {}
+        self.prefixes = {}
+        self.handler = None
+
+class CommandTrie:
+    # Verbs stored word by word. Each word of a verb may be shortened to any
+    # prefix no other verb word in the same position starts with, so "l at"
+    # finds "look at" and "tal to" finds "talk to", and matching a command
+    # only costs as many dict lookups as it has words.
+    def __init__(self):
+        self.root = CommandNode()
+
+    def add(self, verb, handler):
+        node = self.root
+        for word in verb.lower().split():
+            child = node.children.get(word)
+            if child is None:
+                child = node.children[word] = CommandNode()
+                for end in range(1, len(word) + 1):
+                    prefix = word[:end]
+                    # None marks a prefix shared by several words.
+                    node.prefixes[prefix] = None if prefix in node.prefixes else child
+            node = child
+        node.handler = handler
+
+    def match(self, command):
+        # Returns (handler, argument) for the longest verb the command starts
+        # with, or (None, command) if it starts with none.
+        words = command.split()
+        node = self.root
+        handler, used = None, 0
+        for i, word in enumerate(words):
+            node = node.children.get(word) or node.prefixes.get(word)
+            if node is None:
+                break
+            if node.handler is not None:
+                handler, used = node.handler, i + 1
+        return handler, ' '.join(words[used:])
+
+LEAVE, GIVE, TAKE = 'leave', 'give', 'take'
+DIALOGUE_ACTION_PATTERN = re.compile(r'\((?:Leaves to the (?P<leave>[^)]+)|(?P<kind>Give|Take) (?P<item>[^)]+))\)')
+
+class DialogueChoice:
+    # An edge of the dialogue graph. actions holds the (kind, argument) pairs
+    # written into the option or its reply, e.g. (LEAVE, 'Laboratory') or
+    # (GIVE, 'Book'), found once when the script is parsed. location is the
+    # (file, line) the option was first written at.
+    __slots__ = ('text', 'node', 'actions', 'location')
+
+    def __init__(self, text, node, actions=(), location=None):
+        self.text = text
+        self.node = node
+        self.actions = actions
+        self.location = location
 
 class DialogueNode:
-    def __init__(self, text):
+    # Nodes never change once compiled: choices is a tuple, and identical
+    # subtrees are shared between branches, dialogues and scenes.
+    __slots__ = ('text', 'choices', '__weakref__')
+
+    def __init__(self, text, choices=()):
         self.text = text
-        self.choices = []
+        self.choices = choices
+
+def dialogue_actions(*texts):
+    actions = []
+    for text in texts:
+        for match in DIALOGUE_ACTION_PATTERN.finditer(text):
+            if match.group('leave'):
+                actions.append((LEAVE, match.group('leave').strip()))
+            else:
+                actions.append((match.group('kind').lower(), match.group('item').strip()))
+    return tuple(actions)
+
+SCENE_HEADER = '## Scene: '
+SECTION_HEADER = '### '
+GLOBAL_COMBINATIONS_HEADER = '## Global Item Combinations'
+
+def iter_markdown_blocks(lines, first_lineno=1):
+    # Single pass over the script. Yields ('scene', name, None, lineno) for
+    # every scene header and ('section', header, body_lines, lineno) /
+    # ('combinations', None, body_lines, lineno) once a block is complete,
+    # where lineno is the line the body starts on.
+    kind = name = None
+    body = []
+    start = 0
+    for lineno, line in enumerate(lines, first_lineno):
+        line = line.rstrip('\r\n')
+        if line.startswith(SCENE_HEADER):
+            if kind:
+                yield kind, name, body, start
+            kind, body = None, []
+            yield 'scene', line[len(SCENE_HEADER):].strip(), None, lineno
+        elif line.startswith(GLOBAL_COMBINATIONS_HEADER):
+            if kind:
+                yield kind, name, body, start
+            kind, name, body, start = 'combinations', None, [], lineno + 1
+        elif line.startswith(SECTION_HEADER) and kind != 'combinations':
+            if kind:
+                yield kind, name, body, start
+            kind, name, body, start = 'section', line[len(SECTION_HEADER):].strip(), [], lineno + 1
+        elif kind:
+            body.append(line)
+    if kind:
+        yield kind, name, body, start
+
+def split_markdown_blocks(text, first_lineno=1):
+    # Cuts a script into the pieces iter_scenes() can parse on their own:
+    # one per scene or global combinations header, plus whatever comes
+    # before the first. Yields (first line number, text).
+    starts = [0]
+    position = text.find('\n## ')
+    while position != -1:
+        position += 1
+        if text.startswith(SCENE_HEADER, position) or text.startswith(GLOBAL_COMBINATIONS_HEADER, position):
+            starts.append(position)
+        position = text.find('\n## ', position)
+    starts.append(len(text))
+    lineno = first_lineno
+    for start, end in zip(starts, starts[1:]):
+        if end > start:
+            yield lineno, text[start:end]
+            lineno += text.count('\n', start, end)
+
+def join_block(body, lineno):
+    first = 0
+    while first < len(body) and not body[first].strip():
+        first += 1
+    return '\n'.join(body[first:]).strip(), lineno + first
+
+def file_digest(file, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class WorldCache:
+    # Compiled worlds are stored per source file so that editing one chapter
+    # only recompiles that chapter. An entry is reused as long as the file's
+    # mtime and size are unchanged, or its content hash still matches. Entries
+    # are pickles, so the cache lives in a directory of the user's own, and
+    # they are tagged with a hash of this module as well as CACHE_VERSION:
+    # any change to the parser makes every entry stale.
+    parser_digest = None
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        if WorldCache.parser_digest is None:
+            WorldCache.parser_digest = file_digest(__file__)
+        self.version = f"{CACHE_VERSION}:{WorldCache.parser_digest}"
+
+    def entry_path(self, file):
+        key = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def read_entry(self, file):
+        try:
+            with open(self.entry_path(file), 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+        if not isinstance(entry, dict) or entry.get('version') != self.version:
+            return None
+        return entry
 
-    def add_choice(self, choice_text, next_node):
-        self.choices.append((choice_text, next_node))
+    def write_entry(self, file, entry):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        path = self.entry_path(file)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, file, parse):
+        stat = os.stat(file)
+        entry = self.read_entry(file)
+        if entry and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry['scenes'], entry['combinations']
+
+        digest = file_digest(file)
+        if not entry or entry['sha256'] != digest:
+            scenes, combinations = parse(file)
+            entry = {'version': self.version, 'source': os.path.abspath(file), 'sha256': digest,
+                     'scenes': scenes, 'combinations': combinations}
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['size'] = stat.st_size
+        self.write_entry(file, entry)
+        return entry['scenes'], entry['combinations']
+
+class Journal:
+    # A saved session: snapshot.json holds the state at some point and
+    # journal.jsonl the changes made since, one JSON array per command.
+    # Saving a command appends one line; every compact_every lines the state
+    # is written to a new snapshot and the journal starts over. Lines carry
+    # increasing sequence numbers and the snapshot records the last one it
+    # includes, so a crash between replacing the snapshot and truncating
+    # the journal never applies a change twice.
+    def __init__(self, path, compact_every=1000, fsync=False):
+        self.path = path
+        self.snapshot_path = os.path.join(path, 'snapshot.json')
+        self.log_path = os.path.join(path, 'journal.jsonl')
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.seq = 0
+        self.entries = 0
+        self.file = None
+
+    def read(self):
+        # Returns (snapshot or None, the change lists of the lines to replay).
+        # A last line cut short by a crash is dropped and cut off the file;
+        # damage anywhere else raises ValueError.
+        snapshot = None
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+        if snapshot is not None and snapshot.get('version') != JOURNAL_VERSION:
+            raise ValueError(f"{self.snapshot_path}: unsupported save version {snapshot.get('version')!r}")
+        self.seq = snapshot['seq'] if snapshot else 0
+
+        entries = []
+        good = size = 0
+        try:
+            with open(self.log_path, 'rb') as f:
+                for line in f:
+                    size += len(line)
+                    try:
+                        entry = json.loads(line) if line.endswith(b'\n') else None
+                    except ValueError:
+                        entry = None
+                    if entry is None:
+                        if f.read(1):
+                            raise ValueError(f"{self.log_path}: damaged entry at byte {good}")
+                        break
+                    good = size
+                    if entry[0] > self.seq:
+                        self.seq = entry[0]
+                        entries.append(entry[1:])
+        except FileNotFoundError:
+            pass
+        if good < size:
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(good)
+        self.entries = len(entries)
+        return snapshot, entries
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.file = open(self.log_path, 'a', encoding='utf-8')
+
+    def sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def append(self, changes):
+        self.seq += 1
+        self.file.write(json.dumps([self.seq, *changes], separators=(',', ':')) + '\n')
+        self.sync(self.file)
+        self.entries += 1
+
+    def write_snapshot(self, state):
+        state = dict(state, version=JOURNAL_VERSION, seq=self.seq)
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+            self.sync(f)
+        os.replace(tmp_path, self.snapshot_path)
+        self.file.truncate(0)
+        self.sync(self.file)
+        self.entries = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class LRUCache:
+    # A dict that keeps only its size most recently used entries.
+    __slots__ = ('size', 'entries')
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def pop(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+# Top-level headers that matter to the lazy index: scene and global
+# combination headers delimit blocks, and a scene-level combination section
+# means that scene has to be parsed up front.
+INDEX_HEADER_PATTERN = re.compile(
+    rb'^(?:' + re.escape(SCENE_HEADER.encode('utf-8')) + rb'([^\r\n]*)'
+    + rb'|(' + re.escape(GLOBAL_COMBINATIONS_HEADER.encode('utf-8')) + rb')'
+    + rb'|' + re.escape(SECTION_HEADER.encode('utf-8')) + rb'Item Combinations)',
+    re.MULTILINE)
+
+class LazySceneMap(Mapping):
+    # Drop-in replacement for the scenes dict. Loading only records where each
+    # scene lives (file, byte offset, length, first line); a scene is parsed
+    # from the memory-mapped file the first time it is looked up and kept in
+    # a bounded LRU afterwards. Scenes are read-only (player changes live in
+    # the session), so evicting one never loses anything. Before a scene is
+    # parsed its file's mtime and size are compared with the indexed ones;
+    # if a file was rewritten since, every file is indexed again.
+    def __init__(self, parser, cache_size=256):
+        self.parser = parser
+        self.files = []
+        self.maps = []
+        self.stats = []
+        self.index = {}
+        self.cache = LRUCache(cache_size)
+
+    def add_file(self, file, combinations):
+        self.files.append(file)
+        self.maps.append(b'')
+        self.stats.append(None)
+        self.index_file(len(self.files) - 1, combinations)
+
+    def index_file(self, file_id, combinations):
+        with open(self.files[file_id], 'rb') as f:
+            stat = os.fstat(f.fileno())
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        self.maps[file_id] = data
+        self.stats[file_id] = (stat.st_mtime_ns, stat.st_size)
+
+        blocks = []
+        for match in INDEX_HEADER_PATTERN.finditer(data):
+            name = match.group(1)
+            if name is not None:
+                blocks.append([match.start(), name, False])
+            elif match.group(2):
+                blocks.append([match.start(), None, True])
+            elif blocks:
+                blocks[-1][2] = True
+
+        lineno = 1
+        previous = 0
+        for i, (offset, name, has_combinations) in enumerate(blocks):
+            end = blocks[i + 1][0] if i + 1 < len(blocks) else len(data)
+            lineno += data[previous:offset].count(b'\n')
+            previous = offset
+            if name is not None:
+                key = name.decode('utf-8').strip().lower()
+                self.index[key] = (file_id, offset, end - offset, lineno)
+                self.cache.pop(key)
+            if has_combinations:
+                # Combination tables are global, so they are collected up front.
+                self.parse_block(file_id, offset, end - offset, lineno, combinations)
+
+    def parse_block(self, file_id, offset, length, lineno, combinations):
+        text = self.maps[file_id][offset:offset + length].decode('utf-8')
+        scenes = self.parser.iter_scenes(text.split('\n'), combinations, self.files[file_id], lineno)
+        return next(scenes, None)
+
+    def changed(self, file_id):
+        try:
+            stat = os.stat(self.files[file_id])
+        except OSError:
+            return True
+        return (stat.st_mtime_ns, stat.st_size) != self.stats[file_id]
+
+    def reindex(self):
+        # Recipes were collected at load time, so the ones found now are
+        # dropped; scenes are looked up again through the new offsets.
+        maps = self.maps
+        self.maps = [b''] * len(self.files)
+        self.index = {}
+        self.cache.clear()
+        for file_id in range(len(self.files)):
+            try:
+                self.index_file(file_id, [])
+            except OSError as error:
+                self.parser.report(f"could not index again: {error}", self.files[file_id])
+        for data in maps:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.parser.scene_graph.invalidate()
+
+    def locate(self, key):
+        entry = self.index.get(key)
+        if entry is not None and self.changed(entry[0]):
+            self.reindex()
+            entry = self.index.get(key)
+        return entry
+
+    def close(self):
+        for data in self.maps:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.maps = []
+
+    def __getitem__(self, key):
+        scene = self.cache.get(key)
+        if scene is not None:
+            return scene
+        entry = self.locate(key)
+        if entry is None:
+            raise KeyError(key)
+        file_id, offset, length, lineno = entry
+        start = time.perf_counter() if self.parser.profiler is not None else None
+        scene = self.parse_block(file_id, offset, length, lineno, [])
+        if self.parser.profiler is not None:
+            self.parser.profiler.record('parse.scene', start)
+        if scene is None:
+            raise ValueError(f"{self.files[file_id]}: scene {key!r} changed while it was read")
+        scene = freeze(scene)
+        self.cache.put(key, scene)
+        return scene
+
+    def __contains__(self, key):
+        return key in self.cache or self.locate(key) is not None
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+class SceneGraph:
+    # The exits of every scene as compact adjacency arrays: scene i's exits
+    # are targets[offsets[i]:offsets[i + 1]] (scene ids, exits to missing
+    # scenes left out), with the reverse edges stored the same way. Routes
+    # come from a breadth-first search back from the destination, which
+    # gives the next step towards it from every scene at once; the last
+    # few destinations' results are kept, so a popular destination costs one
+    # search and then only the length of each route. Built on first use and
+    # rebuilt after invalidate(), which a reload calls.
+    def __init__(self, scenes, cache_size=16):
+        self.scenes = scenes
+        self.routes = LRUCache(cache_size)
+        self.invalidate()
+
+    def invalidate(self):
+        self.keys = None
+        self.ids = None
+        self.names = None
+        self.routes.clear()
+
+    def build(self):
+        keys = list(self.scenes)
+        ids = {key: position for position, key in enumerate(keys)}
+        offsets = array('i', [0])
+        targets = array('i')
+        for key in keys:
+            for exit in self.scenes[key]['content'].get('Exits', ()):
+                target = ids.get(exit.lower())
+                if target is not None:
+                    targets.append(target)
+            offsets.append(len(targets))
+        # The same edges grouped by target, by counting sort.
+        reverse_offsets = array('i', bytes(4 * (len(keys) + 1)))
+        for target in targets:
+            reverse_offsets[target + 1] += 1
+        for position in range(len(keys)):
+            reverse_offsets[position + 1] += reverse_offsets[position]
+        filled = array('i', reverse_offsets[:-1])
+        sources = array('i', bytes(4 * len(targets)))
+        for source in range(len(keys)):
+            for edge in range(offsets[source], offsets[source + 1]):
+                target = targets[edge]
+                sources[filled[target]] = source
+                filled[target] += 1
+        self.offsets, self.targets = offsets, targets
+        self.reverse_offsets, self.sources = reverse_offsets, sources
+        self.keys, self.ids = keys, ids
+
+    def next_steps(self, target):
+        # For every scene id, the id of the next scene on a shortest route
+        # to target (-1 where target cannot be reached).
+        steps = self.routes.get(target)
+        if steps is not None:
+            return steps
+        steps = array('i', [-1]) * len(self.keys)
+        steps[target] = target
+        reverse_offsets, sources = self.reverse_offsets, self.sources
+        frontier = [target]
+        while frontier:
+            following = []
+            for scene in frontier:
+                for edge in range(reverse_offsets[scene], reverse_offsets[scene + 1]):
+                    source = sources[edge]
+                    if steps[source] < 0:
+                        steps[source] = scene
+                        following.append(source)
+            frontier = following
+        self.routes.put(target, steps)
+        return steps
+
+    def route(self, source, target):
+        # The scene keys walked through from source to target, target
+        # included, or None if there is no way there.
+        if self.keys is None:
+            self.build()
+        start, goal = self.ids.get(source), self.ids.get(target)
+        if start is None or goal is None:
+            return None
+        steps = self.next_steps(goal)
+        if steps[start] < 0:
+            return None
+        path = []
+        while start != goal:
+            start = steps[start]
+            path.append(self.keys[start])
+        return path
+
+    def match(self, query, tier):
+        if tier == 'exact':
+            return [query] if query in self.scenes else []
+        if self.names is None:
+            self.names = NameIndex((key, scene['name']) for key, scene in self.scenes.items())
+        return self.names.match(query, tier)
+
+    def display(self, key):
+        return self.scenes[key]['name']
+
+class Renderer:
+    # Headless renderer: output is collected per frame and flush() returns it.
+    def __init__(self):
+        self.frame = []
+
+    def write(self, text=''):
+        self.frame.append(text)
+        self.frame.append('\n')
+
+    def type(self, text):
+        self.write(text)
+
+    def clear(self):
+        self.frame.clear()
+
+    def flush(self):
+        text = ''.join(self.frame)
+        self.frame.clear()
+        return text
+
+class TypedText(str):
+    pass
+
+class TerminalRenderer(Renderer):
+    # Writes each frame to the terminal in one go. Text passed to type() is
+    # revealed typewriter style, a batch of characters per animation frame
+    # rather than one flush and sleep per character.
+    CLEAR = '\033[2J\033[H'
+
+    def __init__(self, stream=None, typewriter=True, pace=0.01, fps=60):
+        super().__init__()
+        self.stream = stream or sys.stdout
+        self.typewriter = typewriter
+        self.frame_time = 1 / fps
+        self.chars_per_frame = max(1, round(self.frame_time / pace)) if pace else 0
+
+    def type(self, text):
+        if self.typewriter and self.chars_per_frame:
+            self.frame.append(TypedText(text))
+            self.frame.append('\n')
+        else:
+            self.write(text)
+
+    def clear(self):
+        self.frame.clear()
+        self.frame.append(self.CLEAR)
+
+    def flush(self):
+        chunk = []
+        for part in self.frame:
+            if isinstance(part, TypedText):
+                self.stream.write(''.join(chunk))
+                chunk = []
+                for start in range(0, len(part), self.chars_per_frame):
+                    self.stream.write(part[start:start + self.chars_per_frame])
+                    self.stream.flush()
+                    time.sleep(self.frame_time)
+            else:
+                chunk.append(part)
+        self.stream.write(''.join(chunk))
+        self.stream.flush()
+        return super().flush()
+
+# Upper bounds, in seconds, of the command latency histogram buckets.
+LATENCY_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1.0)
+SECTION_PHASES = {'Dialogues': 'parse.dialogues', 'Characters': 'parse.characters', 'Items': 'parse.items',
+                  'Item Combinations': 'parse.combinations'}
+
+class Histogram:
+    __slots__ = ('counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # Upper bound of the bucket the q-th observation falls in.
+        rank = q * self.count()
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Profiler:
+    # Opt-in instrumentation, enabled with --profile or S2G_PROFILE. Load
+    # phases add up call counts and seconds, commands go into a latency
+    # histogram per verb, and with allocations=True tracemalloc snapshots are
+    # taken after loading and on export. The engine only checks whether it
+    # has a profiler, so a disabled one costs nothing but that check.
+    # Files parsed on worker processes show up only in the 'load' phase.
+    def __init__(self, allocations=False, top=10):
+        self.phases = {}
+        self.commands = {}
+        self.snapshots = {}
+        self.allocations = allocations
+        self.top = top
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def record(self, phase, start):
+        elapsed = time.perf_counter() - start
+        totals = self.phases.get(phase)
+        if totals is None:
+            totals = self.phases[phase] = [0, 0.0]
+        totals[0] += 1
+        totals[1] += elapsed
+
+    def observe(self, verb, seconds):
+        histogram = self.commands.get(verb)
+        if histogram is None:
+            histogram = self.commands[verb] = Histogram()
+        histogram.observe(seconds)
+
+    def verb(self, game, command):
+        # What a command will be counted as, worked out before it runs since
+        # running it may end the dialogue or leave the scene.
+        if game.current_dialogue_node:
+            return 'dialogue choice'
+        if game.pending_combination:
+            return 'combination choice'
+        command = command.strip().lower()
+        if command.casefold() in game.scenes[game.current_scene]['exits'].names:
+            return 'exit'
+        handler, _ = game.commands.match(command)
+        if handler is None:
+            return 'other'
+        name = getattr(handler, '__name__', 'command')
+        return name.removeprefix('handle_').removesuffix('_command').replace('_', ' ')
+
+    def step(self, game, command):
+        # Script2Game.step() with each part timed: the command itself, saving
+        # it and writing the frame (typewriter pauses and screen clears
+        # included).
+        verb = self.verb(game, command)
+        start = time.perf_counter()
+        game.dispatch(command)
+        self.observe(verb, time.perf_counter() - start)
+        start = time.perf_counter()
+        game.commit()
+        self.record('journal.commit', start)
+        start = time.perf_counter()
+        text = game.renderer.flush()
+        self.record('render.flush', start)
+        return text
+
+    def snapshot(self, label):
+        if not self.allocations or not tracemalloc.is_tracing():
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+        self.snapshots[label] = {
+            'current_bytes': current,
+            'peak_bytes': peak,
+            'top': [{'site': f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                     'bytes': stat.size, 'count': stat.count} for stat in stats],
+        }
+
+    def to_dict(self):
+        return {
+            'phases': {phase: {'calls': calls, 'seconds': seconds} for phase, (calls, seconds) in self.phases.items()},
+            'commands': {verb: {'count': histogram.count(),
+                                'seconds': histogram.total,
+                                'p50': histogram.quantile(0.5),
+                                'p99': histogram.quantile(0.99),
+                                'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                                                    histogram.counts))}
+                         for verb, histogram in self.commands.items()},
+            'allocations': self.snapshots,
+        }
+
+    def to_prometheus(self):
+        lines = ['# HELP s2g_phase_seconds_total Time spent in each load or play phase.',
+                 '# TYPE s2g_phase_seconds_total counter']
+        lines += [f's2g_phase_seconds_total{{phase="{phase}"}} {seconds:.9f}' for phase, (_, seconds) in self.phases.items()]
+        lines += ['# HELP s2g_phase_calls_total Times each phase ran.', '# TYPE s2g_phase_calls_total counter']
+        lines += [f's2g_phase_calls_total{{phase="{phase}"}} {calls}' for phase, (calls, _) in self.phases.items()]
+        lines += ['# HELP s2g_command_seconds Command latency by verb.', '# TYPE s2g_command_seconds histogram']
+        for verb, histogram in self.commands.items():
+            seen = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                seen += count
+                lines.append(f's2g_command_seconds_bucket{{verb="{verb}",le="{bound}"}} {seen}')
+            lines.append(f's2g_command_seconds_sum{{verb="{verb}"}} {histogram.total:.9f}')
+            lines.append(f's2g_command_seconds_count{{verb="{verb}"}} {seen}')
+        if self.snapshots:
+            lines += ['# HELP s2g_traced_bytes Memory traced by tracemalloc at each snapshot.',
+                      '# TYPE s2g_traced_bytes gauge']
+            lines += [f's2g_traced_bytes{{snapshot="{label}"}} {snapshot["current_bytes"]}'
+                      for label, snapshot in self.snapshots.items()]
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        # JSON for .json paths, the Prometheus text format otherwise.
+        self.snapshot('exit')
+        with open(path, 'w', encoding='utf-8') as f:
+            if path.endswith('.json'):
+                json.dump(self.to_dict(), f, indent=2)
+            else:
+                f.write(self.to_prometheus())
+
+def freeze(value):
+    # Parsed worlds are shared between sessions and never changed after
+    # loading: dicts become read-only views and lists become tuples.
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def load_markdown_file(file, cache_dir=None):
+    # Process pool entry point: parse one file in a worker and ship the
+    # scenes and combination entries back to the parent for merging.
+    return Script2Game([], cache_dir=cache_dir).load_markdown_file(file)
+
+AMBIGUOUS = object()
 
 class Script2Game:
-    def __init__(self, markdown_files):
-        self.scenes = {}
-        self.inventory = []
+    # Verb -> handler method. Handlers are called as handler(game, argument,
+    # scene) and return the next scene's name when the command leaves the
+    # scene. Subclasses extend the table, plugins call register_command().
+    COMMANDS = {
+        'talk to': 'handle_talk_to_command',
+        'go to': 'handle_go_to_command',
+        'go': 'handle_go_to_command',
+        'travel to': 'handle_travel_to_command',
+        'travel': 'handle_travel_to_command',
+        'take': 'handle_take_command',
+        'look at': 'handle_look_at_command',
+        'look': 'handle_look_command',
+        'inventory': 'handle_inventory_command',
+        'inv': 'handle_inventory_command',
+        'use': 'handle_use_command',
+        'give': 'handle_give_command',
+        'combine': 'handle_combine_command',
+        'craft': 'handle_craft_command',
+        'craftable': 'handle_craftable_command',
+        'drop': 'handle_drop_command',
+    }
+
+    def __init__(self, markdown_files, cache_dir=None, workers=1, lazy=False, scene_cache_size=256, renderer=None,
+                 profiler=None, render_cache_size=1024):
+        self.renderer = renderer if renderer is not None else TerminalRenderer()
+        self.profiler = profiler
+        self.commands = CommandTrie()
+        self.reported = 0
+        # Compiled dialogue nodes by content, so equal subtrees are stored once.
+        self.dialogue_nodes = weakref.WeakValueDictionary()
+        for verb, method in self.COMMANDS.items():
+            self.register_command(verb, getattr(type(self), method))
+        self.lazy = lazy
+        self.scenes = LazySceneMap(self, scene_cache_size) if lazy else {}
+        self.recipes = RecipeBook()
+        # Formatted scene text shared by every session, see scene_text().
+        self.rendered_scenes = LRUCache(render_cache_size)
+        # Where each world item sits in its scene's item list, filled in per
+        # scene when a save first needs to refer to one of its items.
+        self.item_origins = {}
+        self.scene_item_lists = {}
+        # Every live session of this world, so a reload can carry their
+        # state over; set by main() when the sources are watched.
+        self.sessions = weakref.WeakSet([self])
+        self.watcher = None
+        self.reset_state()
+        self.cache = WorldCache(cache_dir) if cache_dir else None
+        self.workers = workers or os.cpu_count() or 1
+        self.load_markdown_files(markdown_files)
+        # Lazy worlds build the graph on the first travel, as that means
+        # parsing every scene.
+        self.scene_graph = SceneGraph(self.scenes)
+        if not lazy:
+            self.scene_graph.build()
+        if profiler is not None:
+            profiler.snapshot('loaded')
+
+    def reset_state(self):
+        # Everything a player changes lives here, on top of the read-only
+        # world: scenes whose items changed get an ItemOverlay in
+        # scene_items, and revealed containers are tracked by identity.
+        # Items taken in a dialogue are (scene, casefolded name) pairs, since
+        # a character gives each of its items once.
+        self.inventory = Inventory(self.recipes)
         self.variables = {}
+        self.scene_items = {}
+        self.revealed = set()
+        self.dialogue_taken = set()
         self.current_scene = None
         self.current_dialogue_node = None
-        self.item_combinations = defaultdict(list)
-        self.load_markdown_files(markdown_files)
+        self.pending_combination = None
+        # Item lists of scenes this session changed, formatted; made on first use.
+        self.rendered_items = None
+        # Saving: the open Journal, and ids for items made during play.
+        self.journal = None
+        self.changes = []
+        self.item_ids = {}
+        self.items_by_id = {}
+        self.next_item_id = 1
+
+    def register_command(self, verb, handler):
+        # Sessions share the command table, so this adds the verb for every
+        # player of the world.
+        self.commands.add(verb, handler)
+
+    def new_session(self, renderer=None):
+        # Another player in the same world. Nothing is copied: the session
+        # starts with an empty state layer over the shared scenes.
+        session = copy.copy(self)
+        session.renderer = renderer if renderer is not None else Renderer()
+        session.reset_state()
+        self.sessions.add(session)
+        return session
 
     def load_markdown_files(self, markdown_files):
-        for file in markdown_files:
-            with open(file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                scene_pattern = r'## Scene: (.+?)\n(.*?)(?=\n## Scene: |## Global Item Combinations|$)'
-                scenes = re.findall(scene_pattern, content, re.DOTALL)
-                for scene_name, scene_content in scenes:
-                    scene_name = scene_name.strip()
-                    scene_content = scene_content.strip()
-                    self.scenes[scene_name.lower()] = {
-                        'name': scene_name,
-                        'content': self.parse_scene(scene_content)
-                    }
-                
-                global_combinations_pattern = r'## Global Item Combinations\n(.*?$)'
-                global_combinations_content = re.search(global_combinations_pattern, content, re.DOTALL)
-                if global_combinations_content:
-                    global_combinations_content = global_combinations_content.group(1).strip()
-                    self.parse_item_combinations(global_combinations_content)
-
-    def parse_scene(self, content):
-        parsed = {}
-        pattern = r'### (.+?)\n(.*?)(?=\n### |$)'
-        sections = re.findall(pattern, content, re.DOTALL)
-        for header, body in sections:
-            header = header.strip()
-            body = body.strip()
-            if header == 'Dialogues':
-                parsed[header] = self.parse_dialogues(body)
-            elif header == 'Characters':
-                parsed[header] = self.parse_characters(body)
-            elif header == 'Items':
-                parsed[header] = self.parse_items(body)
-            elif header == 'Item Combinations':
-                self.parse_item_combinations(body)
-            else:
-                parsed[header] = self.parse_section_content(body)
-        return parsed
+        start = time.perf_counter() if self.profiler is not None else None
+        self.merge_markdown_files(markdown_files)
+        if self.profiler is not None:
+            self.profiler.record('load', start)
 
-    def parse_dialogues(self, content):
-        lines = content.strip().split('\n')
+    def merge_markdown_files(self, markdown_files):
+        markdown_files = list(markdown_files)
+        if self.lazy:
+            combinations = []
+            for file in markdown_files:
+                start = time.perf_counter() if self.profiler is not None else None
+                self.scenes.add_file(file, combinations)
+                if self.profiler is not None:
+                    self.profiler.record('load.index', start)
+            for recipe in combinations:
+                self.recipes.add(recipe)
+            return
+        if self.workers > 1 and len(markdown_files) > 1:
+            results = self.parse_in_parallel(markdown_files)
+        else:
+            results = map(self.load_markdown_file, markdown_files)
+        # Results arrive in file order either way, so later files still
+        # override earlier scenes and combinations keep their source order.
+        for scenes, combinations in results:
+            for key, scene in scenes.items():
+                self.scenes[key] = freeze(scene)
+            for recipe in combinations:
+                self.recipes.add(recipe)
+
+    def parse_in_parallel(self, markdown_files):
+        workers = min(self.workers, len(markdown_files))
+        chunksize = max(1, len(markdown_files) // (workers * 4))
+        cache_dir = self.cache.cache_dir if self.cache else None
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(load_markdown_file, markdown_files, repeat(cache_dir), chunksize=chunksize))
+
+    def load_markdown_file(self, file):
+        start = time.perf_counter() if self.profiler is not None else None
+        if self.cache:
+            result = self.cache.load(file, self.parse_markdown_file)
+        else:
+            result = self.parse_markdown_file(file)
+        if self.profiler is not None:
+            self.profiler.record('load.file', start)
+        return result
+
+    def parse_markdown(self, lines, source=None):
+        combinations = []
+        scenes = {}
+        for scene in self.iter_scenes(lines, combinations, source):
+            scenes[scene['key']] = scene
+        return scenes, combinations
+
+    def parse_markdown_file(self, file):
+        with open(file, 'r', encoding='utf-8') as f:
+            return self.parse_markdown(f, source=file)
+
+    def iter_scenes(self, lines, combinations, source=None, first_lineno=1):
+        # Scenes are yielded as soon as their last section has been parsed, so
+        # callers that do not keep them only ever hold one section in memory.
+        if isinstance(lines, str):
+            lines = lines.split('\n')
+        scene = None
+        for kind, name, body, lineno in iter_markdown_blocks(lines, first_lineno):
+            if kind == 'scene':
+                if scene is not None:
+                    yield self.finish_scene(scene)
+                # lines maps each section header to the line its body starts on.
+                scene = {'name': name, 'content': {}, 'source': source, 'lineno': lineno, 'lines': {}}
+                continue
+            content, lineno = join_block(body, lineno)
+            if kind == 'combinations':
+                start = time.perf_counter() if self.profiler is not None else None
+                combinations.extend(self.parse_item_combinations(content, source, lineno))
+                if self.profiler is not None:
+                    self.profiler.record('parse.combinations', start)
+            elif scene is not None:
+                scene['lines'][name] = lineno
+                self.parse_section(scene['content'], name, content, combinations, source, lineno)
+        if scene is not None:
+            yield self.finish_scene(scene)
+
+    def finish_scene(self, scene):
+        scene['key'] = scene['name'].lower()
+        scene['characters'] = NameIndex((name.casefold(), name) for name in scene['content'].get('Characters', {}))
+        scene['exits'] = NameIndex((name.casefold(), name) for name in scene['content'].get('Exits', []))
+        return scene
+
+    def parse_section(self, parsed, header, body, combinations, source=None, lineno=None):
+        start = time.perf_counter() if self.profiler is not None else None
+        if header == 'Dialogues':
+            parsed[header] = self.parse_dialogues(body, source, lineno)
+        elif header == 'Characters':
+            parsed[header] = self.parse_characters(body)
+        elif header == 'Items':
+            parsed[header] = self.parse_items(body)
+        elif header == 'Item Combinations':
+            combinations.extend(self.parse_item_combinations(body, source, lineno))
+        else:
+            parsed[header] = self.parse_section_content(body)
+        if self.profiler is not None:
+            self.profiler.record(SECTION_PHASES.get(header, 'parse.sections'), start)
+
+    def report(self, message, source=None, lineno=None):
+        self.reported += 1
+        if source:
+            message = f"{source}:{lineno}: {message}" if lineno else f"{source}: {message}"
+        print(message)
+
+    def parse_dialogues(self, content, source=None, lineno=None):
+        # Nesting follows indentation: an option ("1. ...") belongs to the
+        # nearest less indented line above it, and lines indented under an
+        # option are its reply. Unindented speaker lines before the first
+        # option make up one conversation that every one of those speakers
+        # opens. Nodes are built as [lines, choices] and compiled at the end.
         dialogues = {}
-        current_speaker = None
+        conversation = None
         stack = []
-        for line in lines:
-            stripped = line.lstrip()
-            indent = len(line) - len(stripped)
-            if ':' in stripped:
-                parts = stripped.split(':', 1)
-                speaker = parts[0].strip()
-                text = parts[1].strip()
-                lower_speaker = speaker.lower()
-                if lower_speaker not in dialogues:
-                    dialogues[lower_speaker] = DialogueNode(f"{speaker}: {text}")
-                    stack = [dialogues[lower_speaker]]
-                    current_speaker = lower_speaker
-                else:
-                    print("Error: Multiple dialogues for the same speaker.")
-            elif stripped.startswith('1.') or stripped.startswith('2.') or stripped.startswith('3.') or stripped.startswith('4.') or stripped.startswith('5.'):
-                option_text = stripped[3:].strip()
-                new_node = DialogueNode(option_text)
+        for offset, line in enumerate(content.split('\n')):
+            line_lineno = lineno + offset if lineno else None
+            stripped = line.strip()
+            if not stripped or (stripped == 'None' and conversation is None):
+                continue
+            indent = len(line) - len(line.lstrip())
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            number, dot, option_text = stripped.partition('. ')
+            if number.isdigit() and dot:
                 if stack:
-                    parent_node = stack[-1]
-                    parent_node.add_choice(option_text, new_node)
-                    stack.append(new_node)
+                    node = [[], []]
+                    stack[-1][1][1].append((option_text.strip(), node, (source, line_lineno)))
+                    stack.append((indent, node))
                 else:
-                    print("Error: Option without a parent node.")
+                    self.report("Error: Option without a parent node.", source, line_lineno)
+                continue
+            speaker, colon, text = stripped.partition(':')
+            at_top = len(stack) <= 1
+            if at_top and colon and (conversation is None or conversation[1]):
+                key = speaker.strip().casefold()
+                if key in dialogues:
+                    self.report("Error: Multiple dialogues for the same speaker.", source, line_lineno)
+                    continue
+                conversation = dialogues[key] = [[f"{speaker.strip()}: {text.strip()}"], []]
+                stack = [(-1, conversation)]
+            elif at_top and conversation is not None:
+                conversation[0].append(stripped)
+                if colon:
+                    dialogues.setdefault(speaker.strip().casefold(), conversation)
+            elif stack:
+                stack[-1][1][0].append(stripped)
             else:
-                if current_speaker and stack:
-                    current_node = stack[-1]
-                    current_node.text += '\n' + stripped
-                else:
-                    print("Warning: Orphaned line in dialogues.")
-        return dialogues
+                self.report("Warning: Orphaned line in dialogues.", source, line_lineno)
+        compiled = {}
+        return {key: self.compile_dialogue(node, compiled) for key, node in dialogues.items()}
+
+    def compile_dialogue(self, node, compiled, fallback_text=''):
+        # Turns a parsed [lines, choices] node into a DialogueNode, reusing an
+        # existing node with the same text and choices where there is one.
+        if id(node) in compiled:
+            return compiled[id(node)]
+        lines, choices = node
+        text = sys.intern('\n'.join(lines) or fallback_text)
+        edges = tuple(
+            DialogueChoice(sys.intern(choice_text), child, dialogue_actions(choice_text, child.text), location)
+            for choice_text, child, location in (
+                (choice_text, self.compile_dialogue(child, compiled, choice_text), location)
+                for choice_text, child, location in choices))
+        key = (text, tuple((edge.text, id(edge.node)) for edge in edges))
+        dialogue = self.dialogue_nodes.get(key)
+        if dialogue is None:
+            dialogue = self.dialogue_nodes[key] = DialogueNode(text, edges)
+        compiled[id(node)] = dialogue
+        return dialogue
 
     def parse_characters(self, content):
         characters = {}
@@ -119,15 +1430,14 @@ class Script2Game:
         return characters
 
     def parse_items(self, content):
-        items = []
+        items = ItemStore()
         lines = content.strip().split('\n')
         current_item = None
         for line in lines:
             if line.startswith('####'):
                 nested_item = line.lstrip('####').strip()
                 if current_item:
-                    current_item['contains'] = nested_item
-                    items[-1] = current_item
+                    current_item.contains = nested_item
                     current_item = None
             else:
                 item_name = line.lstrip('- ').strip()
@@ -136,29 +1446,24 @@ class Script2Game:
                 description = None
                 if '##### Description:' in line:
                     description = line.split('##### Description:')[1].strip()
-                current_item = {'name': item_name, 'contains': None, 'movable': movable, 'description': description, 'revealed': False}
-                items.append(current_item)
+                current_item = Item(item_name, movable=movable, description=description)
+                items.add(current_item)
         return items
 
-    def parse_item_combinations(self, content):
-        lines = content.strip().split('\n')
-        i = 0
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('- '):
-                line = line.strip('- ')
-                if ' = ' in line:
-                    result_side, ingredients_side = line.split(' = ')
-                    result_item_name = result_side.strip().split(': ')[0].strip().lower()
-                    description = None
-                    if ': ' in result_side:
-                        description = result_side.split(': ')[1].strip()
-                    items = re.split(r'\s*\+\s*', ingredients_side.strip())
-                    if len(items) == 2:
-                        item1, item2 = items[0].strip().lower(), items[1].strip().lower()
-                        self.item_combinations[tuple(sorted([item1, item2]))].append((result_item_name, description))
-                        print(f"Parsed combination: {tuple(sorted([item1, item2]))} = {result_item_name}")
-            i += 1
+    def parse_item_combinations(self, content, source=None, lineno=None):
+        # "- Ingredient + Ingredient [+ ...] = Result: description"
+        combinations = []
+        for offset, line in enumerate(content.split('\n')):
+            line = line.strip()
+            if not line.startswith('- ') or ' = ' not in line:
+                continue
+            ingredients_side, _, result_side = line[2:].partition(' = ')
+            ingredients = [name.strip() for name in ingredients_side.split('+')]
+            result, _, description = result_side.partition(':')
+            if len(ingredients) >= 2 and all(ingredients) and result.strip():
+                location = (source, lineno + offset if lineno else None)
+                combinations.append(Recipe(ingredients, result.strip(), description.strip() or None, location))
+        return combinations
 
     def parse_section_content(self, content):
         lines = content.strip().split('\n')
@@ -169,336 +1474,1434 @@ class Script2Game:
         else:
             return lines
 
-    def display_text(self, text, pace=0.01):
-        for char in text:
-            print(char, end='', flush=True)
-            time.sleep(pace)
-        print()
+    def display_text(self, text):
+        self.renderer.type(text)
+
+    def get_scene_items(self, scene):
+        items = self.scene_items.get(scene['key'])
+        return items if items is not None else scene['content'].get('Items', EMPTY_ITEMS)
+
+    def update_scene_items(self, scene):
+        # The first change to a scene gives this session an overlay on top of
+        # the scene's shared item store.
+        items = self.scene_items.get(scene['key'])
+        if items is None:
+            items = self.scene_items[scene['key']] = ItemOverlay(scene['content'].get('Items', EMPTY_ITEMS))
+        return items
+
+    def is_revealed(self, item):
+        return item in self.revealed
+
+    def reveal(self, item, scene):
+        self.revealed.add(item)
+        self.scene_changed(scene)
+        if self.journal:
+            self.record('reveal', self.item_ref(item, scene))
+
+    # Every change to the state layer goes through these, so a journaled
+    # session saves it as it happens.
+    def enter_scene(self, scene_name):
+        self.current_scene = scene_name.lower()
+        if self.journal:
+            self.record('scene', self.current_scene)
+
+    def add_to_inventory(self, item):
+        self.inventory.add(item)
+        if self.journal:
+            self.record('inv+', self.item_ref(item))
+
+    def remove_from_inventory(self, item):
+        if self.journal:
+            self.record('inv-', self.item_ref(item))
+        self.inventory.remove(item)
+
+    def add_to_scene(self, scene, item):
+        self.update_scene_items(scene).add(item)
+        self.scene_changed(scene)
+        if self.journal:
+            self.record('room+', scene['key'], self.item_ref(item, scene))
+
+    def remove_from_scene(self, scene, item):
+        if self.journal:
+            self.record('room-', scene['key'], self.item_ref(item, scene))
+        self.update_scene_items(scene).remove(item)
+        self.scene_changed(scene)
+
+    def take_in_dialogue(self, name):
+        taken = (self.current_scene, name.casefold())
+        self.dialogue_taken.add(taken)
+        if self.journal:
+            self.record('took', *taken)
+
+    def scene_changed(self, scene):
+        if self.rendered_items is not None:
+            self.rendered_items.pop(scene['key'])
+
+    def record(self, *change):
+        self.changes.append(change)
+
+    def commit(self):
+        # Saves the changes one command made as a single journal line, so a
+        # crash keeps all of them or none.
+        if self.journal and self.changes:
+            self.journal.append(self.changes)
+            self.changes = []
+            if self.journal.entries >= self.journal.compact_every:
+                self.journal.write_snapshot(self.snapshot())
+
+    def update_world(self, scenes, added=(), removed=()):
+        # Swaps reloaded scenes (key -> new scene, or None for a scene that is
+        # gone) and recipes into the shared world, then carries every
+        # session's state over. Items of a reloaded scene are matched to the
+        # new scene's items by name, in order, so whatever a player took,
+        # dropped or revealed stays that way while the item still exists.
+        moved = {}
+        for key, scene in scenes.items():
+            old = self.scenes.get(key)
+            cached = self.scene_item_lists.pop(key, None)
+            if cached is not None:
+                for item in cached[1]:
+                    self.item_origins.pop(item, None)
+            if old is not None and scene is not None:
+                fresh = {}
+                for item in scene['content'].get('Items', EMPTY_ITEMS):
+                    fresh.setdefault(item.key, []).append(item)
+                for item in old['content'].get('Items', EMPTY_ITEMS):
+                    candidates = fresh.get(item.key)
+                    if candidates:
+                        moved[item] = candidates.pop(0)
+            if scene is None:
+                self.scenes.pop(key, None)
+            else:
+                self.scenes[key] = scene
+                if cached is not None:
+                    # Saves already refer to this scene's items.
+                    self.scene_item_list(key)
+        if scenes:
+            self.scene_graph.invalidate()
+        # Adding first keeps a recipe that only moved from dropping out.
+        added = [recipe for recipe in added if self.recipes.add(recipe)]
+        dropped = [recipe for recipe in map(self.recipes.remove, removed) if recipe is not None]
+        for session in list(self.sessions):
+            session.carry_over(scenes, moved, added, dropped)
+
+    def carry_over(self, scenes, moved, added, dropped):
+        self.rendered_items = None
+        for recipe in dropped:
+            self.inventory.untrack(recipe)
+        for recipe in added:
+            self.inventory.track(recipe)
+        # A moved item keeps its name, so the plain ItemStore swap leaves the
+        # recipe progress as it is.
+        for item in [item for item in self.inventory if item in moved]:
+            ItemStore.remove(self.inventory, item)
+            ItemStore.add(self.inventory, moved[item])
+        self.revealed = {moved.get(item, item) for item in self.revealed}
+        for key, scene in scenes.items():
+            overlay = self.scene_items.pop(key, None)
+            if overlay is None or scene is None:
+                continue
+            fresh = self.update_scene_items(scene)
+            fresh.removed = {moved[item] for item in overlay.removed if item in moved}
+            for item in overlay.added:
+                fresh.add(moved.get(item, item))
+        if moved:
+            for overlay in self.scene_items.values():
+                for item in [item for item in overlay.added if item in moved]:
+                    overlay.added.remove(item)
+                    overlay.added.add(moved[item])
+        if self.pending_combination:
+            items, recipes = self.pending_combination
+            if any(recipe in dropped for recipe in recipes):
+                self.pending_combination = None
+                self.renderer.write("The recipes changed. Combine the items again.")
+            else:
+                self.pending_combination = ([moved.get(item, item) for item in items], recipes)
+        if self.current_scene is not None and self.current_scene not in self.scenes:
+            self.current_dialogue_node = None
+            self.enter_scene(next(iter(self.scenes)))
+            self.play_scene(self.current_scene)
+            self.renderer.write("\nThe place you were in is gone.")
+        if self.journal:
+            # Saves refer to the world as it is now loaded.
+            self.commit()
+            self.journal.write_snapshot(self.snapshot())
+
+    def scene_item_list(self, key):
+        base = self.scenes[key]['content'].get('Items', EMPTY_ITEMS)
+        cached = self.scene_item_lists.get(key)
+        if cached is None or cached[0] is not base:
+            cached = self.scene_item_lists[key] = (base, list(base))
+            for position, item in enumerate(cached[1]):
+                self.item_origins[item] = (key, position)
+        return cached[1]
+
+    def item_ref(self, item, scene=None):
+        # How a save refers to an item: [scene, position, key] for an item of
+        # the world, a number for one made during play. The first reference
+        # to a made item journals what it is.
+        item_id = self.item_ids.get(item)
+        if item_id is not None:
+            return item_id
+        origin = self.item_origins.get(item)
+        if origin is None and scene is not None:
+            self.scene_item_list(scene['key'])
+            origin = self.item_origins.get(item)
+        if origin is not None:
+            return [*origin, item.key]
+        item_id = self.item_ids[item] = self.next_item_id
+        self.next_item_id += 1
+        self.items_by_id[item_id] = item
+        if self.journal:
+            self.record('new', *self.item_record(item))
+        return item_id
+
+    def item_record(self, item):
+        return [self.item_ids[item], item.name, item.contains, item.movable, item.description]
+
+    def find_ref(self, ref):
+        # The item a save refers to, or None if the world no longer has it.
+        # The markdown may have changed since the save was made: an item of
+        # the world that is not at its position any more is matched by name
+        # to the nearest item of the scene that has it, and a scene that is
+        # gone has none of its items left.
+        if isinstance(ref, int):
+            return self.items_by_id[ref]
+        key, position, *name = ref
+        if key not in self.scenes:
+            return None
+        items = self.scene_item_list(key)
+        if not name:
+            # Saved before references carried the item's name.
+            return items[position] if position < len(items) else None
+        if position < len(items) and items[position].key == name[0]:
+            return items[position]
+        same = [index for index, item in enumerate(items) if item.key == name[0]]
+        if not same:
+            return None
+        return items[min(same, key=lambda index: abs(index - position))]
+
+    def find_refs(self, refs):
+        return [item for item in map(self.find_ref, refs) if item is not None]
+
+    def snapshot(self):
+        # The session state as JSON-ready data. Made items nothing refers to
+        # any more are left out and forgotten.
+        live = set()
+
+        def refs(items):
+            result = []
+            for item in items:
+                ref = self.item_ref(item)
+                if isinstance(ref, int):
+                    live.add(item)
+                result.append(ref)
+            return result
+
+        scenes = {key: {'removed': refs(overlay.removed), 'added': refs(overlay.added)}
+                  for key, overlay in self.scene_items.items()}
+        state = {'scene': self.current_scene, 'variables': self.variables, 'inventory': refs(self.inventory),
+                 'revealed': refs(self.revealed), 'scenes': scenes,
+                 'taken': [list(taken) for taken in self.dialogue_taken]}
+        self.item_ids = {item: item_id for item, item_id in self.item_ids.items() if item in live}
+        self.items_by_id = {item_id: item for item, item_id in self.item_ids.items()}
+        state['items'] = [self.item_record(item) for item in self.item_ids]
+        return state
+
+    def restore_snapshot(self, state):
+        for item_id, name, contains, movable, description in state['items']:
+            self.define_item(item_id, name, contains, movable, description)
+        self.current_scene = state['scene']
+        self.variables = state['variables']
+        for item in self.find_refs(state['inventory']):
+            if item not in self.inventory:
+                self.inventory.add(item)
+        self.revealed = set(self.find_refs(state['revealed']))
+        self.dialogue_taken = {tuple(taken) for taken in state.get('taken', ())}
+        for key, changes in state['scenes'].items():
+            if key not in self.scenes:
+                continue
+            overlay = self.update_scene_items(self.scenes[key])
+            overlay.removed = set(self.find_refs(changes['removed']))
+            for item in self.find_refs(changes['added']):
+                overlay.add(item)
+
+    def define_item(self, item_id, name, contains, movable, description):
+        item = Item(name, contains=contains, movable=movable, description=description)
+        self.item_ids[item] = item_id
+        self.items_by_id[item_id] = item
+        self.next_item_id = max(self.next_item_id, item_id + 1)
+
+    def replay(self, change):
+        op, *args = change
+        if op == 'scene':
+            self.current_scene = args[0]
+        elif op == 'new':
+            self.define_item(*args)
+        elif op in ('inv+', 'inv-', 'reveal'):
+            item = self.find_ref(args[0])
+            if item is None:
+                return
+            if op == 'inv+' and item not in self.inventory:
+                self.inventory.add(item)
+            elif op == 'inv-' and item in self.inventory:
+                self.inventory.remove(item)
+            elif op == 'reveal':
+                self.revealed.add(item)
+        elif op in ('room+', 'room-'):
+            item = self.find_ref(args[1])
+            if item is None or args[0] not in self.scenes:
+                return
+            if op == 'room+':
+                self.update_scene_items(self.scenes[args[0]]).add(item)
+            else:
+                self.update_scene_items(self.scenes[args[0]]).remove(item)
+        elif op == 'took':
+            self.dialogue_taken.add(tuple(args))
+        else:
+            raise ValueError(f"unknown journal entry {change!r}")
+
+    def open_save(self, path, compact_every=1000, fsync=False):
+        # Restores the session saved in the directory path, if there is one,
+        # and journals every change from then on. Returns True if a save was
+        # restored.
+        journal = Journal(path, compact_every, fsync)
+        snapshot, entries = journal.read()
+        self.reset_state()
+        if snapshot is not None:
+            self.restore_snapshot(snapshot)
+        for entry in entries:
+            for change in entry:
+                self.replay(change)
+        if self.current_scene is not None and self.current_scene not in self.scenes:
+            # The scene was renamed or removed since: start() picks the first.
+            self.current_scene = None
+        journal.open()
+        self.journal = journal
+        return snapshot is not None or bool(entries)
+
+    def close_save(self):
+        # Compacts the journal so the next resume only has to load a snapshot.
+        if self.journal:
+            self.commit()
+            self.journal.write_snapshot(self.snapshot())
+            self.journal.close()
+            self.journal = None
+
+    def prompt(self, message):
+        return input(message)
+
+    def prompt_text(self):
+        if self.current_dialogue_node:
+            return "Enter the number of your choice or 'E' to exit: "
+        if self.pending_combination:
+            return "Enter the result you want: "
+        return "\nWhat do you want to do? "
 
     def start_game(self):
-        self.current_scene = list(self.scenes.keys())[0]
+        self.start()
+        self.run()
+
+    def start(self, scene_name=None):
+        self.enter_scene(scene_name or self.current_scene or next(iter(self.scenes)))
         self.play_scene(self.current_scene)
+        self.commit()
+        return self.renderer.flush()
+
+    def run(self):
+        # Flat game loop: handlers never enter the next scene themselves, they
+        # return its name and step() switches scenes, so the stack depth
+        # stays the same however many rooms the player walks through.
+        while True:
+            try:
+                command = self.prompt(self.prompt_text())
+            except (KeyboardInterrupt, EOFError):
+                self.close_save()
+                self.renderer.write("\nThank you for playing! Goodbye.")
+                self.renderer.flush()
+                return
+            if self.watcher is not None:
+                try:
+                    for file in self.watcher.poll():
+                        self.renderer.write(f"[{file} reloaded]")
+                except Exception as error:
+                    self.renderer.write(f"[reload failed: {error!r}]")
+            self.step(command)
+
+    def step(self, command):
+        # Runs one line of player input and returns the text it produced.
+        if self.profiler is not None:
+            return self.profiler.step(self, command)
+        self.dispatch(command)
+        self.commit()
+        return self.renderer.flush()
+
+    def dispatch(self, command):
+        if self.current_dialogue_node:
+            next_scene = self.handle_dialogue_choice(command)
+        elif self.pending_combination:
+            next_scene = self.handle_combination_choice(command)
+        else:
+            next_scene = self.handle_command(command.strip().lower(), self.scenes[self.current_scene])
+        if next_scene is not None:
+            if next_scene.lower() in self.scenes:
+                self.enter_scene(next_scene)
+                self.play_scene(self.current_scene)
+            else:
+                self.renderer.write("That way leads nowhere yet.")
 
     def play_scene(self, scene_name):
         scene = self.scenes[scene_name.lower()]
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(f"__{scene['name']}__\n")
+        self.renderer.clear()
+        self.renderer.write(f"__{scene['name']}__\n")
+        self.display_scene(scene)
+        return scene
 
-        self.display_scene_description(scene)
-        self.display_scene_items(scene)
-        self.display_scene_characters(scene)
-        self.display_scene_exits(scene)
+    def display_scene(self, scene):
+        # What entering or looking around a scene shows: the description is
+        # typed out, the rest is written in one go.
+        description, text = self.scene_text(scene)
+        if description:
+            self.display_text(description)
+        if text:
+            self.renderer.write(text)
 
-        while True:
-            try:
-                command = input("\nWhat do you want to do? ").strip().lower()
-                self.handle_command(command, scene)
-            except KeyboardInterrupt:
-                print("\nThank you for playing! Goodbye.")
-                sys.exit(0)
-
-    def display_scene_description(self, scene):
-        if 'Description' in scene['content']:
-            for line in scene['content']['Description']:
-                self.display_text(line)
-
-    def display_scene_items(self, scene):
-        if 'Items' in scene['content']:
-            print("You see:")
-            for item in scene['content']['Items']:
-                print(f"  {item['name']}")
-                if item['revealed'] and item['contains']:
-                    print(f"    Inside, you see: {item['contains']}")
-
-    def display_scene_characters(self, scene):
-        if 'Characters' in scene['content']:
-            for character, details in scene['content']['Characters'].items():
-                print(f"{character} is in the room. {details['description']}")
-                if 'Items' in details:
-                    for item in details['Items']:
-                        print(f"  {character} has: {item}")
-
-    def display_scene_exits(self, scene):
-        if 'Exits' in scene['content']:
-            print("\nExits:")
-            for exit in scene['content']['Exits']:
-                print(f"- {exit}")
+    def scene_text(self, scene):
+        # (description, items + characters + exits) for scene, formatted once
+        # per scene for all sessions, as it reads before anything in it is
+        # revealed. A session that changed the scene's items (revealing one
+        # adds what is inside) keeps its own copy of that text, until the next
+        # take, drop or reveal there. Entries are checked against the scene
+        # itself, so reloaded and re-parsed scenes are formatted again.
+        key = scene['key']
+        cached = self.rendered_scenes.get(key)
+        if cached is None or cached[0] is not scene:
+            content = scene['content']
+            description = '\n'.join(content.get('Description', ()))
+            others = self.format_scene_characters(scene) + self.format_scene_exits(scene)
+            items = self.format_scene_items(scene, content.get('Items', EMPTY_ITEMS), ())
+            cached = (scene, description, '\n'.join(items + others), others)
+            self.rendered_scenes.put(key, cached)
+        items = self.scene_items.get(key)
+        if items is None:
+            return cached[1], cached[2]
+        if self.rendered_items is None:
+            self.rendered_items = LRUCache(32)
+        text = self.rendered_items.get(key)
+        if text is None:
+            text = '\n'.join(self.format_scene_items(scene, items, self.revealed) + cached[3])
+            self.rendered_items.put(key, text)
+        return cached[1], text
+
+    def format_scene_items(self, scene, items, revealed):
+        if 'Items' not in scene['content'] and not items:
+            return []
+        lines = ["You see:"]
+        for item in items:
+            lines.append(f"  {item.name}")
+            if item.contains and item in revealed:
+                lines.append(f"    Inside, you see: {item.contains}")
+        return lines
+
+    def format_scene_characters(self, scene):
+        lines = []
+        for character, details in scene['content'].get('Characters', {}).items():
+            lines.append(f"{character} is in the room. {details['description']}")
+            lines.extend(self.format_character_items(character, details))
+        return lines
+
+    def format_character_items(self, character, details):
+        return [f"  {character} has: {item}" for item in details.get('Items', ())]
+
+    def format_scene_exits(self, scene):
+        if 'Exits' not in scene['content']:
+            return []
+        return ["\nExits:"] + [f"- {exit}" for exit in scene['content']['Exits']]
 
     def handle_command(self, command, scene):
-        if command.startswith('talk to '):
-            self.handle_talk_to_command(command, scene)
-        elif command.startswith('go to '):
-            self.handle_go_to_command(command, scene)
-        elif any(command == exit.lower() for exit in scene['content'].get('Exits', [])):
-            self.handle_exit_command(command, scene)
-        elif command.startswith('take '):
-            self.handle_take_command(command, scene)
-        elif command.startswith('look at '):
-            self.handle_look_at_command(command, scene)
-        elif command == 'look':
-            self.handle_look_command(scene)
-        elif command == 'inventory' or command == 'inv':
-            self.handle_inventory_command()
-        elif command.startswith('use '):
-            self.handle_use_command(command)
-        elif command.startswith('give '):
-            self.handle_give_command(command, scene)
-        elif command.startswith('combine '):
-            self.handle_combine_command(command)
-        elif command.startswith('drop '):
-            self.handle_drop_command(command, scene)
-        else:
-            print("Invalid command. Try again.")
-
-    def handle_talk_to_command(self, command, scene):
-        character = command[8:].strip()
-        if 'Characters' in scene['content'] and character in [char.lower() for char in scene['content']['Characters']]:
-            if 'Dialogues' in scene['content'] and character in scene['content']['Dialogues']:
-                dialogue_root = scene['content']['Dialogues'][character]
-                self.current_dialogue_node = dialogue_root
+        # Returns the name of the next scene when the command leaves this one.
+        exit = scene['exits'].names.get(command.casefold())
+        if exit:
+            return exit
+        handler, argument = self.commands.match(command)
+        if handler is not None:
+            return handler(self, argument, scene)
+        # Not a verb: maybe a shortened exit name, as in "lab" for Laboratory.
+        match = self.resolve(command, scene['exits'])
+        if match is AMBIGUOUS:
+            return None
+        if match:
+            return scene['exits'].display(match[1])
+        self.renderer.write("Invalid command. Try again.")
+
+    def resolve(self, query, *sources):
+        # Finds what the player means by query among the NameIndex-like
+        # sources, in order: an exact name (earlier sources win), then a
+        # unique trailing-words match, then a unique prefix. Returns
+        # (source, key), None if nothing matches, or AMBIGUOUS after listing
+        # the candidates.
+        query = ' '.join(query.casefold().split())
+        if not query:
+            return None
+        for tier in NAME_TIERS:
+            matches = [(source, key) for source in sources for key in source.match(query, tier)]
+            if matches and (tier == 'exact' or len(matches) == 1):
+                return matches[0]
+            if matches:
+                names = ', '.join(source.display(key) for source, key in matches[:MAX_CANDIDATES])
+                self.renderer.write(f"Which do you mean: {names}?")
+                return AMBIGUOUS
+        return None
+
+    def resolve_item(self, query, items):
+        match = self.resolve(query, items)
+        if match is None or match is AMBIGUOUS:
+            return match
+        return items.find(match[1])
+
+    def handle_talk_to_command(self, argument, scene):
+        match = self.resolve(argument, scene['characters'])
+        if match is AMBIGUOUS:
+            return
+        if match:
+            dialogue_root = scene['content'].get('Dialogues', {}).get(match[1])
+            if dialogue_root:
                 self.handle_dialogue(dialogue_root)
             else:
-                print("No dialogue available for this character.")
+                self.renderer.write("No dialogue available for this character.")
         else:
-            print("No one by that name here.")
+            self.renderer.write("No one by that name here.")
 
-    def handle_go_to_command(self, command, scene):
-        exit_name = command[6:].strip().lower()
-        matching_exits = [exit for exit in scene['content'].get('Exits', []) if exit.lower() == exit_name]
-        if matching_exits:
-            self.current_scene = matching_exits[0].lower()
-            self.play_scene(self.current_scene)
-        else:
-            print("Invalid exit. Try again.")
+    def handle_go_to_command(self, argument, scene):
+        match = self.resolve(argument, scene['exits'])
+        if match is AMBIGUOUS:
+            return None
+        if match:
+            return scene['exits'].display(match[1])
+        self.renderer.write("Invalid exit. Try again.")
 
-    def handle_exit_command(self, command, scene):
-        self.current_scene = next(exit.lower() for exit in scene['content']['Exits'] if exit.lower() == command)
-        self.play_scene(self.current_scene)
+    def handle_travel_to_command(self, argument, scene):
+        # Walks the shortest way to any scene in one command. Every scene on
+        # the way is entered as if the player had walked there; only the
+        # destination is shown.
+        match = self.resolve(argument, self.scene_graph)
+        if match is AMBIGUOUS:
+            return None
+        if not match:
+            self.renderer.write("No such place.")
+            return None
+        if match[1] == scene['key']:
+            self.renderer.write(f"You are already in {scene['name']}.")
+            return None
+        route = self.scene_graph.route(scene['key'], match[1])
+        if route is None:
+            self.renderer.write(f"You can't find a way to {self.scene_graph.display(match[1])} from here.")
+            return None
+        for key in route:
+            self.enter_scene(key)
+        self.play_scene(route[-1])
+        if len(route) > 1:
+            passed = [self.scenes[key]['name'] for key in route[:-1]]
+            self.renderer.write(f"\nYou travelled through {', '.join(passed[:MAX_LISTED])}"
+                                f"{f' and {len(passed) - MAX_LISTED} more places' if len(passed) > MAX_LISTED else ''}.")
 
-    def handle_take_command(self, command, scene):
-        item = command[5:].strip().lower()
-        scene_items = [i['name'].lower() for i in scene['content'].get('Items', [])]
-        if item in scene_items:
-            actual_item = next(i for i in scene['content']['Items'] if i['name'].lower() == item)
-            if actual_item['movable']:
-                self.inventory.append(actual_item)
-                scene['content']['Items'].remove(actual_item)
-                print(f"You have picked up: {actual_item['name']}")
+    def handle_take_command(self, argument, scene):
+        actual_item = self.resolve_item(argument, self.get_scene_items(scene))
+        if actual_item is AMBIGUOUS:
+            return
+        if actual_item:
+            if actual_item.movable:
+                self.remove_from_scene(scene, actual_item)
+                self.add_to_inventory(actual_item)
+                self.renderer.write(f"You have picked up: {actual_item.name}")
             else:
-                print("Not too handy to take along.")
+                self.renderer.write("Not too handy to take along.")
         else:
-            print("No such item here.")
-
-    def handle_look_at_command(self, command, scene):
-        target = command[8:].strip().lower()
-        scene_items = [i['name'].lower() for i in scene['content'].get('Items', [])]
-        inventory_items = [i['name'].lower() for i in self.inventory]
-
-        if target in scene_items:
-            actual_item = next(i for i in scene['content']['Items'] if i['name'].lower() == target)
-            print(f"You see: {actual_item['name']}")
-            if actual_item['contains']:
-                print(f"Inside, you see: {actual_item['contains']}")
-                # Reveal the nested item
-                nested_item = {'name': actual_item['contains'], 'contains': None, 'movable': True, 'description': actual_item.get('description', None), 'revealed': True}
-                scene['content']['Items'].append(nested_item)
-                actual_item['revealed'] = True
-            if actual_item['description']:
-                print(f"Description: {actual_item['description']}")
-        elif target in inventory_items:
-            actual_item = next(i for i in self.inventory if i['name'].lower() == target)
-            print(f"You see: {actual_item['name']}")
-            if actual_item['contains']:
-                print(f"Inside, you see: {actual_item['contains']}")
-            if actual_item['description']:
-                print(f"Description: {actual_item['description']}")
-        elif 'Characters' in scene['content']:
-            characters = {name.lower(): details for name, details in scene['content']['Characters'].items()}
-            if target in characters:
-                print(f"{target.capitalize()}: {characters[target]['description']}")
-                if 'Items' in characters[target]:
-                    for item in characters[target]['Items']:
-                        print(f"  {target.capitalize()} has: {item}")
-            else:
-                print("No such item or character here.")
+            self.renderer.write("No such item here.")
+
+    def handle_look_at_command(self, argument, scene):
+        scene_items = self.get_scene_items(scene)
+        match = self.resolve(argument, scene_items, self.inventory, scene['characters'])
+        if match is AMBIGUOUS:
+            return
+        source, key = match or (None, None)
+
+        if source is scene_items:
+            scene_item = scene_items.find(key)
+            self.renderer.write(f"You see: {scene_item.name}")
+            if scene_item.contains:
+                self.renderer.write(f"Inside, you see: {scene_item.contains}")
+                if not self.is_revealed(scene_item):
+                    # Reveal the nested item
+                    nested_item = Item(scene_item.contains, description=scene_item.description)
+                    self.add_to_scene(scene, nested_item)
+                    self.reveal(scene_item, scene)
+            if scene_item.description:
+                self.renderer.write(f"Description: {scene_item.description}")
+        elif source is self.inventory:
+            inventory_item = self.inventory.find(key)
+            self.renderer.write(f"You see: {inventory_item.name}")
+            if inventory_item.contains:
+                self.renderer.write(f"Inside, you see: {inventory_item.contains}")
+            if inventory_item.description:
+                self.renderer.write(f"Description: {inventory_item.description}")
+        elif source is not None:
+            character = source.display(key)
+            details = scene['content']['Characters'][character]
+            self.renderer.write(f"{character}: {details['description']}")
+            for line in self.format_character_items(character, details):
+                self.renderer.write(line)
         else:
-            print("No such item or character here.")
-
-    def handle_look_command(self, scene):
-        if 'Description' in scene['content']:
-            for line in scene['content']['Description']:
-                self.display_text(line)
-        if 'Items' in scene['content']:
-            print("You see:")
-            for item in scene['content']['Items']:
-                print(f"  {item['name']}")
-                if item['revealed'] and item['contains']:
-                    print(f"    Inside, you see: {item['contains']}")
-        if 'Characters' in scene['content']:
-            for character, details in scene['content']['Characters'].items():
-                print(f"{character} is in the room. {details['description']}")
-                if 'Items' in details:
-                    for item in details['Items']:
-                        print(f"  {character} has: {item}")
-        if 'Exits' in scene['content']:
-            print("\nExits:")
-            for exit in scene['content']['Exits']:
-                print(f"- {exit}")
-
-    def handle_inventory_command(self):
+            self.renderer.write("No such item or character here.")
+
+    def handle_look_command(self, argument, scene):
+        if argument:
+            return self.handle_look_at_command(argument, scene)
+        self.display_scene(scene)
+
+    def handle_inventory_command(self, argument, scene):
         if self.inventory:
-            print("Inventory:")
+            self.renderer.write("Inventory:")
             for item in self.inventory:
-                print(f"- {item['name']}")
-                if item['description']:
-                    print(f"  ({item['description']})")
+                self.renderer.write(f"- {item.name}")
+                if item.description:
+                    self.renderer.write(f"  ({item.description})")
         else:
-            print("Your inventory is empty.")
-
-    def handle_use_command(self, command):
-        item = command[4:].strip().lower()
-        inventory_items = {i['name'].lower(): i for i in self.inventory}
-        if item in inventory_items:
-            actual_item = inventory_items[item]
-            print(f"You use {actual_item['name']}.")
+            self.renderer.write("Your inventory is empty.")
+
+    def handle_use_command(self, argument, scene):
+        actual_item = self.resolve_item(argument, self.inventory)
+        if actual_item is AMBIGUOUS:
+            return
+        if actual_item:
+            self.renderer.write(f"You use {actual_item.name}.")
             # Add specific effects based on the item used
-            if actual_item['name'] == 'key':
-                print("You unlock the door with the key.")
+            if actual_item.name == 'key':
+                self.renderer.write("You unlock the door with the key.")
                 # Add logic to handle the unlocked door
         else:
-            print("You don't have that item.")
-
-    def handle_give_command(self, command, scene):
-        item = command[5:].strip().lower()
-        inventory_items = {i['name'].lower(): i for i in self.inventory}
-        if item in inventory_items:
-            actual_item = inventory_items[item]
-            print(f"You give {actual_item['name']}.")
+            self.renderer.write("You don't have that item.")
+
+    def handle_give_command(self, argument, scene):
+        actual_item = self.resolve_item(argument, self.inventory)
+        if actual_item is AMBIGUOUS:
+            return
+        if actual_item:
+            self.renderer.write(f"You give {actual_item.name}.")
             # Add specific effects based on the item given
-            if actual_item['name'] == 'book':
-                print("Sherlock Holmes: And that is exactly what I was looking for!")
-                self.inventory.remove(actual_item)
+            if actual_item.name == 'book':
+                self.renderer.write("Sherlock Holmes: And that is exactly what I was looking for!")
+                self.remove_from_inventory(actual_item)
         else:
-            print("You don't have that item.")
+            self.renderer.write("You don't have that item.")
 
-    def handle_combine_command(self, command):
+    def handle_combine_command(self, argument, scene):
         # Split the command by '+' to separate the items
-        parts = command.split('+')
-        if len(parts) != 2:
-            print("Invalid command format. Use: combine item1 + item2")
+        parts = argument.split('+')
+        if len(parts) < 2:
+            self.renderer.write("Invalid command format. Use: combine item1 + item2 [+ item3 ...]")
             return
 
-        item1 = parts[0].strip().lower()
-        item2 = parts[1].strip().lower()
-
-        # Remove the 'combine ' prefix from the first item
-        if item1.startswith('combine '):
-            item1 = item1[len('combine '):].strip().lower()
-
-        inventory_items = {i['name'].lower(): i for i in self.inventory}
-
-        print(f"Debug: Trying to combine '{item1}' and '{item2}'")  # Debug print
-        print(f"Debug: Inventory items: {list(inventory_items.keys())}")  # Debug print
-
-        if item1 in inventory_items and item2 in inventory_items:
-            combination_key = tuple(sorted([item1, item2]))
-            if combination_key in self.item_combinations:
-                possible_results = self.item_combinations[combination_key]
-                if len(possible_results) == 1:
-                    result_name, description = possible_results[0]
-                    result_item = {'name': result_name, 'contains': None, 'movable': True, 'description': description, 'revealed': False}
-                    self.inventory.remove(inventory_items[item1])
-                    self.inventory.remove(inventory_items[item2])
-                    self.inventory.append(result_item)
-                    print(f"You create a new item: {result_name}.")
-                    if description:
-                        print(f"Description: {description}")
-                else:
-                    print("Multiple possible results. Specify which result you want.")
-                    for result_name, description in possible_results:
-                        print(f"- {result_name} (Description: {description if description else 'None'})")
-                    result_name = input("Enter the result you want: ").strip().lower()
-                    for possible_result_name, possible_description in possible_results:
-                        if possible_result_name.lower() == result_name:
-                            result_item = {'name': possible_result_name, 'contains': None, 'movable': True, 'description': possible_description, 'revealed': False}
-                            self.inventory.remove(inventory_items[item1])
-                            self.inventory.remove(inventory_items[item2])
-                            self.inventory.append(result_item)
-                            print(f"You create a new item: {possible_result_name}.")
-                            if possible_description:
-                                print(f"Description: {possible_description}")
-                            return
-                    print("Invalid result specified.")
-            else:
-                print("These items cannot be combined.")
+        items = []
+        for part in parts:
+            item = self.resolve_item(part, self.inventory)
+            if item is AMBIGUOUS:
+                return
+            if item is not None and item in items:
+                # The same name twice needs two items carrying it.
+                item = next((other for other in self.inventory.find_all(item.key) if other not in items), None)
+            if item is None:
+                self.renderer.write("You don't have all of those items.")
+                return
+            items.append(item)
+
+        recipes = self.recipes.find(tuple(sorted(item.key for item in items)))
+        if len(recipes) == 1:
+            self.craft(recipes[0], items)
+        elif recipes:
+            self.renderer.write("Multiple possible results. Specify which result you want.")
+            for recipe in recipes:
+                self.renderer.write(f"- {recipe.result} (Description: {recipe.description if recipe.description else 'None'})")
+            self.pending_combination = (items, tuple(recipes))
         else:
-            print("You don't have both items.")
+            self.renderer.write("These items cannot be combined.")
 
+    def handle_combination_choice(self, choice):
+        items, recipes = self.pending_combination
+        self.pending_combination = None
+        result_name = choice.strip().casefold()
+        for recipe in recipes:
+            if recipe.result.casefold() == result_name:
+                self.craft(recipe, items)
+                return
+        self.renderer.write("Invalid result specified.")
 
+    def handle_craft_command(self, argument, scene):
+        # "craft <result>" or "craft <result> x<count>" for a batch.
+        name, times = argument, 1
+        batch = re.fullmatch(r'(.+?)\s+x\s*(\d+)', argument)
+        if batch:
+            name, times = batch.group(1), int(batch.group(2))
+        match = self.resolve(name, self.recipes)
+        if match is AMBIGUOUS:
+            return
+        if match is None:
+            self.renderer.write("No recipe makes that.")
+            return
+        made = 0
+        while made < times:
+            recipe = next((recipe for recipe in self.recipes.producing(match[1]) if recipe in self.inventory.craftable), None)
+            if recipe is None:
+                break
+            self.craft(recipe, announce=times == 1)
+            made += 1
+        if not made:
+            self.renderer.write("You don't have the ingredients.")
+        elif times > 1:
+            self.renderer.write(f"You create {made} x {self.recipes.display(match[1])}.")
+
+    def handle_craftable_command(self, argument, scene):
+        craftable = self.inventory.craftable
+        if not craftable:
+            self.renderer.write("Nothing you carry can be combined.")
+            return
+        self.renderer.write("You can make:")
+        for recipe in islice(craftable, MAX_LISTED):
+            self.renderer.write(f"- {recipe.result} ({' + '.join(recipe.ingredients)})")
+        if len(craftable) > MAX_LISTED:
+            self.renderer.write(f"...and {len(craftable) - MAX_LISTED} more.")
+
+    def craft(self, recipe, items=None, announce=True):
+        # Uses up the given items, or the first ones of each ingredient.
+        if items is None:
+            items = [item for name, count in recipe.needs.items() for item in self.inventory.find_all(name)[:count]]
+        for item in items:
+            self.remove_from_inventory(item)
+        self.add_to_inventory(Item(recipe.result, description=recipe.description))
+        if announce:
+            self.renderer.write(f"You create a new item: {recipe.result}.")
+            if recipe.description:
+                self.renderer.write(f"Description: {recipe.description}")
 
-    def handle_drop_command(self, command, scene):
-        item = command[5:].strip().lower()
-        inventory_items = {i['name'].lower(): i for i in self.inventory}
-        if item in inventory_items:
-            actual_item = inventory_items[item]
-            self.inventory.remove(actual_item)
-            scene['content']['Items'].append(actual_item)
-            print(f"You drop {actual_item['name']}.")
+    def handle_drop_command(self, argument, scene):
+        actual_item = self.resolve_item(argument, self.inventory)
+        if actual_item is AMBIGUOUS:
+            return
+        if actual_item:
+            self.remove_from_inventory(actual_item)
+            self.add_to_scene(scene, actual_item)
+            self.renderer.write(f"You drop {actual_item.name}.")
         else:
-            print("You don't have that item.")
+            self.renderer.write("You don't have that item.")
 
     def handle_dialogue(self, current_node):
-        while current_node:
-            print(current_node.text)
-            if current_node.choices:
-                for i, (choice_text, next_node) in enumerate(current_node.choices, 1):
-                    print(f"{i}. {choice_text}")
-                print("E. Exit dialogue")
-                choice = input("Enter the number of your choice or 'E' to exit: ").strip().lower()
-                if choice == 'e':
-                    self.current_dialogue_node = None
-                    return
-                elif choice.isdigit() and 1 <= int(choice) <= len(current_node.choices):
-                    selected_choice = current_node.choices[int(choice) - 1]
-                    current_node = selected_choice[1]
-                    if '(Leaves to the ' in selected_choice[0]:
-                        new_scene = selected_choice[0].split('(Leaves to the ')[1].split(')')[0].strip().lower()
-                        self.current_scene = new_scene
-                        self.play_scene(self.current_scene)
-                        return
-                else:
-                    print("Invalid choice. Please enter a number corresponding to one of the options or 'E' to exit.")
+        # Shows a dialogue node. While it offers choices the next input line is
+        # read as a choice by handle_dialogue_choice().
+        self.renderer.write(current_node.text)
+        if current_node.choices:
+            for i, choice in enumerate(current_node.choices, 1):
+                self.renderer.write(f"{i}. {choice.text}")
+            self.renderer.write("E. Exit dialogue")
+            self.current_dialogue_node = current_node
+        else:
+            self.current_dialogue_node = None
+
+    def handle_dialogue_choice(self, choice):
+        current_node = self.current_dialogue_node
+        choice = choice.strip().lower()
+        if choice == 'e':
+            self.current_dialogue_node = None
+        elif choice.isdigit() and 1 <= int(choice) <= len(current_node.choices):
+            selected_choice = current_node.choices[int(choice) - 1]
+            if selected_choice.actions:
+                return self.run_dialogue_actions(selected_choice)
+            self.handle_dialogue(selected_choice.node)
+        else:
+            self.renderer.write("Invalid choice. Please enter a number corresponding to one of the options or 'E' to exit.")
+            self.handle_dialogue(current_node)
+
+    def run_dialogue_actions(self, selected_choice):
+        # Applies the choice's (Give X), (Take X) and (Leaves to the X) edges.
+        # A Give the player cannot pay for keeps them at the current node.
+        for kind, argument in selected_choice.actions:
+            if kind == GIVE and not self.inventory.find(argument):
+                self.renderer.write(f"You don't have {argument}.")
+                self.handle_dialogue(self.current_dialogue_node)
+                return None
+        next_scene = None
+        for kind, argument in selected_choice.actions:
+            if kind == GIVE:
+                self.remove_from_inventory(self.inventory.find(argument))
+                self.renderer.write(f"You give {argument}.")
+            elif kind == TAKE:
+                if (self.current_scene, argument.casefold()) in self.dialogue_taken:
+                    self.renderer.write(f"You already received {argument}.")
+                    continue
+                self.take_in_dialogue(argument)
+                self.add_to_inventory(Item(argument))
+                self.renderer.write(f"You receive {argument}.")
+            elif kind == LEAVE:
+                next_scene = argument
+        if next_scene is not None:
+            self.current_dialogue_node = None
+            return next_scene
+        self.handle_dialogue(selected_choice.node)
+        return None
+
+class WorldValidator:
+    # Static checks over a loaded world: the scene graph (exits and dialogue
+    # departures), dialogue graphs and where every item can come from. Each
+    # scene, exit, dialogue node and recipe is looked at a bounded number of
+    # times, so validating takes time linear in the size of the script.
+    def __init__(self, engine):
+        self.engine = engine
+        self.scenes = engine.scenes
+        self.problems = []
+        self.departures = {}
+        self.departure_memo = {}
+        self.seen_nodes = set()
+
+    def problem(self, source, lineno, message):
+        self.problems.append((source or '<unknown>', lineno or 0, message))
+
+    def run(self):
+        # Returns (source, lineno, message) for every problem, in file order.
+        obtainable = self.obtainable_items()
+        for scene in self.scenes.values():
+            self.check_exits(scene)
+            self.check_dialogues(scene, obtainable)
+        self.check_reachability()
+        self.check_recipes(obtainable)
+        self.problems.sort()
+        return self.problems
+
+    def obtainable_items(self):
+        # Names of everything the player can get hold of: scene items and
+        # what they contain, character items, items handed over in dialogue
+        # and, repeatedly, the results of recipes whose ingredients are all
+        # obtainable.
+        names = set()
+        for scene in self.scenes.values():
+            for item in scene['content'].get('Items', EMPTY_ITEMS):
+                names.add(item.key)
+                if item.contains:
+                    names.add(item.contains.casefold())
+            for details in scene['content'].get('Characters', {}).values():
+                names.update(name.casefold() for name in details.get('Items', ()))
+            for root in self.dialogue_roots(scene):
+                for edge in self.iter_edges(root):
+                    names.update(argument.casefold() for kind, argument in edge.actions if kind == TAKE)
+        self.seen_nodes.clear()
+
+        # missing counts the ingredient names of a recipe not obtainable yet;
+        # each name becomes obtainable once, so each recipe is touched once
+        # per ingredient.
+        recipes = self.engine.recipes
+        missing = {}
+        queue = []
+        for recipe in recipes:
+            missing[recipe] = sum(1 for name in recipe.needs if name not in names)
+            if not missing[recipe]:
+                queue.append(recipe.result.casefold())
+        while queue:
+            name = queue.pop()
+            if name in names:
+                continue
+            names.add(name)
+            for recipe in recipes.using(name):
+                missing[recipe] -= 1
+                if not missing[recipe]:
+                    queue.append(recipe.result.casefold())
+        return names
+
+    def dialogue_roots(self, scene):
+        roots = {}
+        for root in scene['content'].get('Dialogues', {}).values():
+            roots[id(root)] = root
+        return roots.values()
+
+    def iter_edges(self, root):
+        # Every edge below root whose node has not been visited yet.
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if id(node) in self.seen_nodes:
+                continue
+            self.seen_nodes.add(id(node))
+            for edge in node.choices:
+                yield edge
+                stack.append(edge.node)
+
+    def check_exits(self, scene):
+        exits = scene['content'].get('Exits', ())
+        lineno = scene['lines'].get('Exits')
+        targets = self.departures.setdefault(scene['key'], [])
+        for offset, exit in enumerate(exits):
+            if not exit or exit.lower() == 'none':
+                continue
+            if exit.lower() in self.scenes:
+                targets.append(exit.lower())
             else:
-                current_node = None
-
-    def get_item_or_character_by_last_word(self, name, items, characters):
-        last_word = name.split()[-1].lower()
-        matching_items = [item for item in items if item['name'].lower().endswith(last_word)]
-        matching_characters = [char for char in characters if char.lower().endswith(last_word)]
-
-        if len(matching_items) == 1 and len(matching_characters) == 0:
-            return matching_items[0]
-        elif len(matching_characters) == 1 and len(matching_items) == 0:
-            return matching_characters[0]
-        elif len(matching_items) + len(matching_characters) > 1:
-            print("Multiple matches found. Please choose the correct one:")
-            for i, item in enumerate(matching_items, 1):
-                print(f"{i}. {item['name']}")
-            for i, char in enumerate(matching_characters, len(matching_items) + 1):
-                print(f"{i}. {char}")
-            choice = input("Enter the number of your choice: ").strip()
-            if choice.isdigit() and 1 <= int(choice) <= len(matching_items) + len(matching_characters):
-                choice_index = int(choice) - 1
-                if choice_index < len(matching_items):
-                    return matching_items[choice_index]
-                else:
-                    return matching_characters[choice_index - len(matching_items)]
+                self.problem(scene['source'], lineno + offset if lineno else scene['lineno'],
+                             f"Exit '{exit}' of '{scene['name']}' leads to no scene.")
+
+    def check_dialogues(self, scene, obtainable):
+        dialogues = scene['content'].get('Dialogues', {})
+        characters = scene['characters']
+        speakers = {}
+        for key, root in dialogues.items():
+            speakers.setdefault(id(root), []).append(key)
+        for root_id, keys in speakers.items():
+            if not any(key in characters.names for key in keys):
+                self.problem(scene['source'], scene['lines'].get('Dialogues', scene['lineno']),
+                             f"Dialogue of '{dialogues[keys[0]].text.partition(':')[0]}' in '{scene['name']}' "
+                             f"belongs to no character in the scene.")
+        targets = self.departures.setdefault(scene['key'], [])
+        for root in self.dialogue_roots(scene):
+            # Edges shared with dialogues checked earlier were reported
+            # there, but their departures still count for this scene.
+            for target in self.dialogue_departures(root):
+                if target.lower() in self.scenes:
+                    targets.append(target.lower())
+            for edge in self.iter_edges(root):
+                self.check_edge(edge, obtainable)
+
+    def dialogue_departures(self, node):
+        # Scenes the dialogue below node can leave to, kept per node because
+        # subtrees are shared.
+        targets = self.departure_memo.get(id(node))
+        if targets is None:
+            found = set()
+            for edge in node.choices:
+                found.update(argument for kind, argument in edge.actions if kind == LEAVE)
+                found.update(self.dialogue_departures(edge.node))
+            targets = self.departure_memo[id(node)] = tuple(found)
+        return targets
+
+    def check_edge(self, edge, obtainable):
+        source, lineno = edge.location or (None, None)
+        if edge.node.text == edge.text and not edge.node.choices and not edge.actions:
+            self.problem(source, lineno, f"Dialogue option '{edge.text}' has no reply and leads nowhere.")
+        for kind, argument in edge.actions:
+            if kind == LEAVE and argument.lower() not in self.scenes:
+                self.problem(source, lineno, f"Dialogue option '{edge.text}' leaves to '{argument}', which is no scene.")
+            elif kind == GIVE and argument.casefold() not in obtainable:
+                self.problem(source, lineno, f"Dialogue option '{edge.text}' asks for '{argument}', which cannot be obtained.")
+
+    def check_reachability(self):
+        if not self.scenes:
+            return
+        start = next(iter(self.scenes))
+        reached = {start}
+        queue = [start]
+        while queue:
+            for target in self.departures.get(queue.pop(), ()):
+                if target not in reached:
+                    reached.add(target)
+                    queue.append(target)
+        start_name = self.scenes[start]['name']
+        for key, scene in self.scenes.items():
+            if key not in reached:
+                self.problem(scene['source'], scene['lineno'], f"Scene '{scene['name']}' cannot be reached from '{start_name}'.")
+
+    def check_recipes(self, obtainable):
+        for recipe in self.engine.recipes:
+            missing = [name for name in recipe.ingredients if name.casefold() not in obtainable]
+            if missing:
+                source, lineno = recipe.location or (None, None)
+                self.problem(source, lineno, f"Recipe for '{recipe.result}' can never be made: nothing provides "
+                                             f"{', '.join(repr(name) for name in dict.fromkeys(missing))}.")
+
+class SourceBlock:
+    # One piece of a watched file as split_markdown_blocks() cut it: the
+    # digest of its text, the key of the scene it defines (if any), the
+    # recipes it defines and, once parsed by the watcher, the scene itself.
+    __slots__ = ('digest', 'key', 'recipes', 'scene')
+
+    def __init__(self, digest, key, recipes, scene=None):
+        self.digest = digest
+        self.key = key
+        self.recipes = recipes
+        self.scene = scene
+
+class WorldWatcher:
+    # Hot reload for an eagerly loaded world. poll() stats the source files
+    # at most every interval seconds. A file whose content changed is cut
+    # into blocks again and only blocks whose text changed are parsed, so a
+    # reload costs the size of the edited file plus the edit, not the world.
+    # Scenes and recipes are swapped in with Script2Game.update_world(),
+    # which carries every session's state over. As when loading, a scene
+    # defined in several files comes from the last of them. Line numbers of
+    # blocks that only moved are not updated.
+    def __init__(self, engine, files, interval=1.0):
+        if engine.lazy:
+            raise ValueError("lazily loaded worlds cannot be watched")
+        self.engine = engine
+        self.files = list(dict.fromkeys(files))
+        self.order = {file: position for position, file in enumerate(self.files)}
+        self.interval = interval
+        self.checked = time.monotonic()
+        self.stats = {}
+        self.blocks = {}
+        # Scene key -> {file: the last block of that file defining it}.
+        self.definitions = {}
+        for file in self.files:
+            self.stats[file] = self.stat(file)
+            self.blocks[file] = [self.index_block(file, lineno, text) for lineno, text in self.read_blocks(file)]
+            self.define(file, self.blocks[file])
+
+    def stat(self, file):
+        try:
+            info = os.stat(file)
+        except OSError:
+            return None
+        return info.st_mtime_ns, info.st_size
+
+    def read_blocks(self, file):
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                return list(split_markdown_blocks(f.read()))
+        except OSError:
+            return []
+
+    def digest(self, text):
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def index_block(self, file, lineno, text):
+        # The baseline for what was loaded: a block is only parsed here if it
+        # holds recipes, since those must be known to take them out again.
+        key = None
+        if text.startswith(SCENE_HEADER):
+            key = text[len(SCENE_HEADER):].split('\n', 1)[0].strip().lower()
+        recipes = []
+        if text.startswith(GLOBAL_COMBINATIONS_HEADER) or SECTION_HEADER + 'Item Combinations' in text:
+            for _ in self.engine.iter_scenes(text, recipes, file, lineno):
+                pass
+        return SourceBlock(self.digest(text), key, recipes)
+
+    def parse_block(self, file, lineno, text, digest):
+        recipes = []
+        scene = next(self.engine.iter_scenes(text, recipes, file, lineno), None)
+        if scene is None:
+            return SourceBlock(digest, None, recipes)
+        return SourceBlock(digest, scene['key'], recipes, freeze(scene))
+
+    def define(self, file, blocks, keys=None):
+        for block in blocks:
+            if block.key is not None and (keys is None or block.key in keys):
+                self.definitions.setdefault(block.key, {})[file] = block
+
+    def winner(self, key):
+        files = self.definitions.get(key)
+        if not files:
+            return None, None
+        file = max(files, key=self.order.__getitem__)
+        return file, files[file]
+
+    def poll(self, force=False):
+        # Reloads the files that changed since the last poll and returns them.
+        now = time.monotonic()
+        if not force and now - self.checked < self.interval:
+            return []
+        self.checked = now
+        reloaded = []
+        for file in self.files:
+            stat = self.stat(file)
+            if stat != self.stats[file] and self.reload(file, stat):
+                reloaded.append(file)
+        return reloaded
+
+    def reload(self, file, stat):
+        # Returns False if the file's content did not actually change. A file
+        # that changed again while it was read, or reads as empty, is most
+        # likely still being written: it is left for the next poll.
+        pieces = self.read_blocks(file)
+        if not pieces or self.stat(file) != stat:
+            return False
+        self.stats[file] = stat
+        unchanged = {}
+        for block in self.blocks[file]:
+            unchanged.setdefault(block.digest, []).append(block)
+        blocks = []
+        parsed = []
+        for lineno, text in pieces:
+            digest = self.digest(text)
+            same = unchanged.get(digest)
+            if same:
+                blocks.append(same.pop(0))
             else:
-                print("Invalid choice. Try again.")
-                return None
+                block = self.parse_block(file, lineno, text, digest)
+                blocks.append(block)
+                parsed.append(block)
+        removed = [block for same in unchanged.values() for block in same]
+        previous = self.blocks[file]
+        if not parsed and not removed:
+            self.blocks[file] = blocks
+            return False
+
+        touched = {block.key for block in parsed + removed if block.key is not None}
+        before = {key: self.winner(key)[1] for key in touched}
+        kept = {key: dict(self.definitions.get(key, {})) for key in touched}
+        for key in touched:
+            self.definitions.get(key, {}).pop(file, None)
+        self.define(file, blocks, touched)
+        self.blocks[file] = blocks
+
+        scenes = {}
+        for key in touched:
+            winner_file, winner = self.winner(key)
+            if winner is before[key]:
+                continue
+            if winner is None:
+                scenes[key] = None
+            else:
+                if winner.scene is None:
+                    self.load_scene(winner_file, winner)
+                scenes[key] = winner.scene
+        left = set(self.engine.scenes)
+        left.difference_update(key for key, scene in scenes.items() if scene is None)
+        if not left and not any(scene is not None for scene in scenes.values()):
+            # Most likely a file emptied while it is being rewritten: the old
+            # definitions stay until a save leaves the game something to play.
+            self.definitions.update(kept)
+            self.blocks[file] = previous
+            self.engine.report("not reloaded, it would leave no scenes", file)
+            return False
+        self.engine.update_world(scenes, [recipe for block in parsed for recipe in block.recipes],
+                                 [recipe for block in removed for recipe in block.recipes])
+        return True
+
+    def load_scene(self, file, block):
+        # A block from the baseline that now defines its scene, because the
+        # definition that overrode it went away.
+        for lineno, text in self.read_blocks(file):
+            if self.digest(text) == block.digest:
+                block.scene = freeze(next(self.engine.iter_scenes(text, [], file, lineno)))
+                return
+
+class Playthrough:
+    # A recorded game: one command per line, typed as the player would,
+    # dialogue choices and answers to combine prompts included. Lines
+    # starting with one of these check the game instead:
+    #   ~ text      the last command's output contains text
+    #   !~ text     the last command's output does not contain text
+    #   @scene X    the player is in scene X
+    #   @has X      the inventory holds X
+    #   @lacks X    the inventory does not hold X
+    #   @start X    start in scene X rather than the first (before any command)
+    # Blank lines and lines starting with # are skipped.
+    def __init__(self, name, steps, start=None):
+        self.name = name
+        self.steps = steps
+        self.start = start
+
+PLAYTHROUGH_CHECKS = (('!~', 'absent'), ('~', 'contains'), ('@scene', 'scene'), ('@has', 'has'),
+                      ('@lacks', 'lacks'), ('@start', 'start'))
+
+def parse_playthrough(lines, name):
+    steps = []
+    start = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        for prefix, kind in PLAYTHROUGH_CHECKS:
+            if stripped.startswith(prefix):
+                argument = stripped[len(prefix):].strip()
+                if kind == 'start':
+                    start = argument
+                else:
+                    steps.append((lineno, kind, argument))
+                break
         else:
-            return None
+            steps.append((lineno, 'command', stripped))
+    return Playthrough(name, steps, start)
+
+def load_playthrough(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return parse_playthrough(f, path)
+
+def run_playthrough(engine, playthrough):
+    # Plays one recorded game on a fresh session of engine. A command that
+    # raises fails the playthrough there rather than stopping the run.
+    session = engine.new_session()
+    failures = []
+    commands = 0
+    lineno, command = 0, '(start)'
+    start = time.perf_counter()
+    try:
+        output = session.start(playthrough.start)
+        for lineno, kind, argument in playthrough.steps:
+            if kind == 'command':
+                command = argument
+                output = session.step(command)
+                commands += 1
+            elif kind == 'contains' and argument not in output:
+                failures.append((lineno, f"expected {argument!r} in the output of {command!r}"))
+            elif kind == 'absent' and argument in output:
+                failures.append((lineno, f"did not expect {argument!r} in the output of {command!r}"))
+            elif kind == 'scene' and session.current_scene != argument.lower():
+                failures.append((lineno, f"expected to be in {argument!r}, not {session.current_scene!r}"))
+            elif kind == 'has' and session.inventory.find(argument) is None:
+                failures.append((lineno, f"expected {argument!r} in the inventory"))
+            elif kind == 'lacks' and session.inventory.find(argument) is not None:
+                failures.append((lineno, f"did not expect {argument!r} in the inventory"))
+    except Exception as error:
+        failures.append((lineno, f"{command!r} raised {error!r}"))
+    finally:
+        session.close_save()
+    return {'name': playthrough.name, 'failures': failures, 'commands': commands,
+            'seconds': time.perf_counter() - start}
+
+# The world each playthrough worker process loads once, see PlaythroughRunner.
+worker_engine = None
+
+def init_playthrough_worker(files, cache_dir, lazy):
+    global worker_engine
+    worker_engine = Script2Game(files, cache_dir=cache_dir, lazy=lazy, renderer=Renderer())
+
+def run_playthrough_in_worker(playthrough):
+    return run_playthrough(worker_engine, playthrough)
+
+class PlaythroughRunner:
+    # Runs recorded playthroughs headlessly against one world, on this
+    # process or spread over a pool where every worker loads the world
+    # once and plays each playthrough on its own session. The profiler only
+    # sees playthroughs run on this process.
+    def __init__(self, files, cache_dir=None, workers=1, lazy=False, profiler=None):
+        self.files = list(files)
+        self.cache_dir = cache_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.lazy = lazy
+        self.profiler = profiler
+
+    def run(self, playthroughs):
+        playthroughs = list(playthroughs)
+        if self.workers == 1 or len(playthroughs) < 2:
+            engine = Script2Game(self.files, cache_dir=self.cache_dir, lazy=self.lazy, renderer=Renderer(),
+                                 profiler=self.profiler)
+            return [run_playthrough(engine, playthrough) for playthrough in playthroughs]
+        workers = min(self.workers, len(playthroughs))
+        chunksize = max(1, len(playthroughs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_playthrough_worker,
+                                 initargs=(self.files, self.cache_dir, self.lazy)) as pool:
+            return list(pool.map(run_playthrough_in_worker, playthroughs, chunksize=chunksize))
+
+def playthrough_paths(paths):
+    # Files as given, directories for the *.play files in them.
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.play'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+class GameServer:
+    # Serves one parsed world to many players over plain TCP (telnet works as
+    # a client). Each connection gets its own session. A session reads its
+    # next command only after the previous reply has been drained to the
+    # client, so a slow reader only stalls itself, and idle sessions are
+    # disconnected after idle_timeout seconds.
+    def __init__(self, engine, host='127.0.0.1', port=4000, idle_timeout=300, max_line=1024,
+                 write_buffer_limit=64 * 1024, backlog=4096):
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.max_line = max_line
+        self.write_buffer_limit = write_buffer_limit
+        self.backlog = backlog
+        self.sessions = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                 limit=self.max_line, backlog=self.backlog)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.server
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def send(self, writer, text):
+        writer.write(text.replace('\n', '\r\n').encode('utf-8'))
+        await asyncio.wait_for(writer.drain(), self.idle_timeout)
+
+    async def handle_client(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+        session = self.engine.new_session()
+        self.sessions += 1
+        try:
+            await self.send(writer, session.start() + session.prompt_text())
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    await self.send(writer, "\nIdle for too long. Goodbye.\n")
+                    break
+                except ValueError:
+                    await self.send(writer, "\nLine too long. Goodbye.\n")
+                    break
+                if not line:
+                    break
+                command = line.decode('utf-8', 'replace').strip()
+                if command.lower() == 'quit':
+                    await self.send(writer, "Thank you for playing! Goodbye.\n")
+                    break
+                await self.send(writer, session.step(command) + session.prompt_text())
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    commands = ('play', 'compile', 'serve', 'validate', 'test')
+    if not argv or argv[0] not in commands:
+        argv.insert(0, 'play')
+
+    parser = argparse.ArgumentParser(prog='script2game', description='Turn markdown documents into CLI text adventures.')
+    subparsers = parser.add_subparsers(dest='command')
+    play_parser = subparsers.add_parser('play', help='play a game')
+    play_parser.add_argument('files', nargs='*', default=['demo.md'])
+    compile_parser = subparsers.add_parser('compile', help='compile markdown files into the world cache')
+    compile_parser.add_argument('files', nargs='+')
+    validate_parser = subparsers.add_parser('validate', help='check markdown files for broken references and unreachable content')
+    validate_parser.add_argument('files', nargs='+')
+    test_parser = subparsers.add_parser('test', help='run recorded playthroughs against a world and check them')
+    test_parser.add_argument('files', nargs='+')
+    test_parser.add_argument('--scripts', nargs='+', required=True, metavar='PATH',
+                             help='playthrough files, or directories of *.play files')
+    test_parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                             help=f'where compiled files are kept (default {DEFAULT_CACHE_DIR})')
+    test_parser.add_argument('--no-cache', action='store_true', help='always parse the markdown files')
+    test_parser.add_argument('--lazy', action='store_true', help='index scenes at startup and parse them on first visit')
+    test_parser.add_argument('--workers', type=int, default=1, help='run playthroughs on this many processes (0 = one per CPU)')
+    test_parser.add_argument('--repeat', type=int, default=1, help='run every playthrough this many times (for load testing)')
+    test_parser.add_argument('--report', metavar='FILE', help='write every result to FILE as JSON')
+    serve_parser = subparsers.add_parser('serve', help='host the game for many players over TCP')
+    serve_parser.add_argument('files', nargs='+')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=4000)
+    serve_parser.add_argument('--idle-timeout', type=float, default=300, help='seconds before an idle player is disconnected')
+    for subparser in (play_parser, compile_parser, serve_parser):
+        subparser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                               help=f'where compiled files are kept (default {DEFAULT_CACHE_DIR})')
+        subparser.add_argument('--workers', type=int, default=1, help='parse files on this many processes (0 = one per CPU)')
+    for subparser in (play_parser, serve_parser):
+        subparser.add_argument('--no-cache', action='store_true', help='always parse the markdown files')
+        subparser.add_argument('--lazy', action='store_true', help='index scenes at startup and parse them on first visit')
+        subparser.add_argument('--watch', type=float, nargs='?', const=1.0, metavar='SECONDS',
+                               help='reload edited files while playing, checking every SECONDS (default 1)')
+    for subparser in (play_parser, compile_parser, validate_parser, test_parser, serve_parser):
+        subparser.add_argument('--profile', metavar='FILE', default=os.environ.get('S2G_PROFILE'),
+                               help='write phase timings and command latencies to FILE on exit '
+                                    '(JSON for .json, Prometheus text otherwise; default $S2G_PROFILE)')
+        subparser.add_argument('--profile-allocations', action='store_true',
+                               default=bool(os.environ.get('S2G_PROFILE_ALLOCATIONS')),
+                               help='with --profile, also record tracemalloc snapshots (slow)')
+    play_parser.add_argument('--no-typewriter', action='store_true', help='print descriptions at once')
+    play_parser.add_argument('--save', metavar='DIR', help='resume the game saved in DIR and keep saving to it')
+    args = parser.parse_args(argv)
+    if getattr(args, 'watch', None) and args.lazy:
+        parser.error('--watch does not work with --lazy')
+    profiler = Profiler(allocations=args.profile_allocations) if args.profile else None
+    try:
+        return run_command(args, profiler)
+    finally:
+        if profiler is not None:
+            profiler.export(args.profile)
+
+def run_command(args, profiler):
+    if args.command == 'compile':
+        start = time.perf_counter()
+        engine = Script2Game(args.files, cache_dir=args.cache_dir, workers=args.workers, profiler=profiler)
+        elapsed = time.perf_counter() - start
+        print(f"Compiled {len(engine.scenes)} scenes from {len(args.files)} file(s) into {args.cache_dir} in {elapsed:.3f}s")
+        return 0
+
+    if args.command == 'validate':
+        # Always parse, so parse errors are reported along with the rest.
+        start = time.perf_counter()
+        engine = Script2Game(args.files, renderer=Renderer(), profiler=profiler)
+        problems = WorldValidator(engine).run()
+        for source, lineno, message in problems:
+            print(f"{source}:{lineno}: {message}")
+        elapsed = time.perf_counter() - start
+        total = len(problems) + engine.reported
+        print(f"{total} problem(s) in {len(engine.scenes)} scenes from {len(args.files)} file(s), checked in {elapsed:.3f}s")
+        return 1 if total else 0
+
+    if args.command == 'test':
+        playthroughs = [load_playthrough(path) for path in playthrough_paths(args.scripts)]
+        runner = PlaythroughRunner(args.files, cache_dir=None if args.no_cache else args.cache_dir,
+                                   workers=args.workers, lazy=args.lazy, profiler=profiler)
+        start = time.perf_counter()
+        results = runner.run(playthroughs * args.repeat)
+        elapsed = time.perf_counter() - start
+        failed = [result for result in results if result['failures']]
+        for result in failed:
+            for lineno, message in result['failures']:
+                print(f"FAIL {result['name']}:{lineno}: {message}")
+        commands = sum(result['commands'] for result in results)
+        print(f"{len(results)} playthrough(s), {len(results) - len(failed)} passed, {len(failed)} failed; "
+              f"{commands} commands in {elapsed:.3f}s ({commands / elapsed:.0f} commands/s, "
+              f"{len(results) / elapsed:.1f} playthroughs/s)")
+        if args.report:
+            with open(args.report, 'w', encoding='utf-8') as f:
+                json.dump({'seconds': elapsed, 'results': results}, f, indent=2)
+        return 1 if failed else 0
+
+    if args.command == 'serve':
+        engine = Script2Game(args.files, cache_dir=None if args.no_cache else args.cache_dir, workers=args.workers,
+                             lazy=args.lazy, renderer=Renderer(), profiler=profiler)
+        server = GameServer(engine, args.host, args.port, idle_timeout=args.idle_timeout)
+        watcher = WorldWatcher(engine, args.files, args.watch) if args.watch else None
+
+        async def watch():
+            while True:
+                await asyncio.sleep(watcher.interval)
+                try:
+                    for file in watcher.poll(force=True):
+                        print(f"Reloaded {file}", flush=True)
+                except Exception as error:
+                    print(f"Reload failed: {error!r}", flush=True)
+
+        async def serve():
+            await server.start()
+            print(f"Serving {len(engine.scenes)} scenes on {server.host}:{server.port}", flush=True)
+            if watcher is None:
+                await server.serve_forever()
+            else:
+                await asyncio.gather(server.serve_forever(), watch())
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    engine = Script2Game(args.files, cache_dir=None if args.no_cache else args.cache_dir, workers=args.workers, lazy=args.lazy,
+                         renderer=TerminalRenderer(typewriter=not args.no_typewriter), profiler=profiler)
+    if args.watch:
+        engine.watcher = WorldWatcher(engine, args.files, args.watch)
+    if args.save:
+        engine.open_save(args.save)
+    engine.start_game()
+    return 0
 
 if __name__ == "__main__":
-    engine = Script2Game(['demo.md'])
-    engine.start_game()
\ No newline at end of file
+    # Run through the importable module so cached worlds pickle classes as
+    # script2game.* rather than __main__.*.
+    import script2game
+    sys.exit(script2game.main())
\ No newline at end of file
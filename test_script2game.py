@@ -0,0 +1,374 @@
+import gc
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pytest
+
+from script2game import Script2Game, Renderer, WorldCache, JOURNAL_VERSION
+from worldgen import generate_world
+
+
+def test_lazy_scenes_follow_a_file_rewritten_in_place(tmp_path):
+    world = generate_world(str(tmp_path), scenes=20, seed=1)
+    engine = Script2Game(world.files, lazy=True, scene_cache_size=2, renderer=Renderer())
+    engine.start(world.scenes[0]['name'])
+    path = world.files[0]
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# Preface\n\nA few lines that move every scene further down.\n\n" + text)
+
+    for scene in world.scenes[1:]:
+        assert engine.scenes[scene['name'].lower()]['name'] == scene['name']
+    target = world.scenes[-1]['name']
+    assert f"__{target}__" in engine.step(f"travel to {target}")
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text.replace(f"## Scene: {target}\n", "## Scene: Somewhere Else\n"))
+    engine.scenes.cache.clear()
+    assert target.lower() not in engine.scenes
+    with pytest.raises(KeyError):
+        engine.scenes[target.lower()]
+    engine.scenes.close()
+
+
+def test_world_cache_entries_go_stale_with_the_parser(tmp_path, monkeypatch):
+    world = generate_world(str(tmp_path / 'world'), scenes=3, seed=1)
+    file = world.files[0]
+    parsed = []
+
+    def parse(file):
+        parsed.append(file)
+        return Script2Game([]).parse_markdown_file(file)
+
+    cache_dir = str(tmp_path / 'cache')
+    WorldCache(cache_dir).load(file, parse)
+    WorldCache(cache_dir).load(file, parse)
+    assert len(parsed) == 1
+    monkeypatch.setattr(WorldCache, 'parser_digest', 'another parser')
+    WorldCache(cache_dir).load(file, parse)
+    assert len(parsed) == 2
+
+
+CELLAR = """## Scene: {name}
+### Description
+A damp cellar.
+
+### Items
+{items}
+"""
+
+
+def play_saved(path, save, commands):
+    engine = Script2Game([path], renderer=Renderer())
+    engine.open_save(save)
+    output = [engine.start()] + [engine.step(command) for command in commands]
+    engine.close_save()
+    return engine, output
+
+
+def test_save_survives_items_inserted_above_a_taken_item(tmp_path):
+    path = tmp_path / 'cellar.md'
+    save = str(tmp_path / 'save')
+    path.write_text(CELLAR.format(name='Cellar', items='- Chest\n- Rope'), encoding='utf-8')
+    play_saved(str(path), save, ['take rope'])
+
+    path.write_text(CELLAR.format(name='Cellar', items='- Lamp\n- Chest\n- Rope'), encoding='utf-8')
+    engine, output = play_saved(str(path), save, [])
+    assert [item.name for item in engine.inventory] == ['Rope']
+    assert 'Rope' not in output[0] and 'Lamp' in output[0] and 'Chest' in output[0]
+
+
+def test_save_of_a_renamed_scene_starts_over_in_the_first_scene(tmp_path):
+    path = tmp_path / 'cellar.md'
+    save = str(tmp_path / 'save')
+    path.write_text(CELLAR.format(name='Cellar', items='- Chest\n- Rope'), encoding='utf-8')
+    play_saved(str(path), save, ['take rope', 'drop rope'])
+
+    path.write_text(CELLAR.format(name='Wine Cellar', items='- Chest\n- Rope'), encoding='utf-8')
+    engine, output = play_saved(str(path), save, ['inv'])
+    assert engine.current_scene == 'wine cellar'
+    assert '__Wine Cellar__' in output[0]
+    assert 'Your inventory is empty.' in output[1]
+
+
+def walk(world, moves):
+    # Goes round the generated world: opens each room's container, pockets
+    # what was inside and one more item, and leaves the previous room's
+    # item behind.
+    made = 0
+    carried = None
+    while True:
+        for index, scene in enumerate(world.scenes):
+            item = scene['items'][1][0]
+            commands = [f"look at {scene['items'][0][0]}", f"take Hidden Note {index}-0", f"take {item}"]
+            if carried:
+                commands.append(f"drop {carried}")
+            commands.append(f"go to {scene['exits'][0]}")
+            carried = item
+            for command in commands:
+                if made == moves:
+                    return
+                yield command
+                made += 1
+
+
+def state_signature(session):
+    return (session.current_scene,
+            [item.name for item in session.inventory],
+            {key: [item.name for item in items] for key, items in session.scene_items.items()},
+            sorted(item.name for item in session.revealed))
+
+
+def resume(engine, save):
+    session = engine.new_session()
+    session.open_save(save)
+    session.journal.close()
+    return session
+
+
+@pytest.fixture
+def saved_game(tmp_path):
+    # A world and a save of 300 moves in it, closed without compacting.
+    world = generate_world(str(tmp_path / 'world'), scenes=10, items=3, containers=1, seed=2)
+    engine = Script2Game(world.files, renderer=Renderer())
+    save = str(tmp_path / 'save')
+    session = engine.new_session()
+    session.open_save(save, compact_every=1000)
+    session.start()
+    for command in walk(world, 300):
+        session.step(command)
+    session.journal.close()
+    return engine, save, state_signature(session)
+
+
+def test_journal_resume_restores_the_state(saved_game):
+    engine, save, expected = saved_game
+    assert state_signature(resume(engine, save)) == expected
+
+
+def test_journal_drops_a_torn_last_line(saved_game):
+    engine, save, expected = saved_game
+    log = os.path.join(save, 'journal.jsonl')
+    with open(log, 'a', encoding='utf-8') as f:
+        f.write('[999999999,"inv+",["hall 0"')
+    assert state_signature(resume(engine, save)) == expected
+    with open(log, 'rb') as f:
+        assert f.read().endswith(b'\n')
+
+
+def test_journal_is_not_replayed_over_a_snapshot_that_already_has_it(saved_game):
+    # A crash after the snapshot was replaced but before the journal was
+    # truncated: every journal line is in the snapshot already.
+    engine, save, expected = saved_game
+    session = resume(engine, save)
+    with open(os.path.join(save, 'snapshot.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(session.snapshot(), version=JOURNAL_VERSION, seq=session.journal.seq), f)
+    assert state_signature(resume(engine, save)) == expected
+
+
+KILLED_PLAYER = """
+import sys
+sys.path.insert(0, sys.argv[1])
+from script2game import Script2Game, Renderer
+engine = Script2Game(sys.argv[3:], renderer=Renderer())
+engine.open_save(sys.argv[2], compact_every=50)
+engine.start()
+print('ready', flush=True)
+while True:
+    scene = engine.scenes[engine.current_scene]
+    for item in scene['content']['Items']:
+        engine.step('take ' + item.name)
+    for item in list(engine.inventory)[:2]:
+        engine.step('drop ' + item.name)
+    engine.step('go to ' + scene['content']['Exits'][0])
+"""
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGKILL'), reason='needs SIGKILL')
+def test_killed_player_resumes_with_every_item_in_one_place(tmp_path):
+    world = generate_world(str(tmp_path / 'world'), scenes=10, items=3, containers=1, seed=3)
+    engine = Script2Game(world.files, renderer=Renderer())
+    save = str(tmp_path / 'save')
+    here = os.path.dirname(os.path.abspath(__file__))
+    for delay in (0.05, 0.15, 0.3):
+        child = subprocess.Popen([sys.executable, '-c', KILLED_PLAYER, here, save, *world.files],
+                                 stdout=subprocess.PIPE)
+        child.stdout.readline()
+        time.sleep(delay)
+        child.send_signal(signal.SIGKILL)
+        child.wait()
+        child.stdout.close()
+        session = resume(engine, save)
+        places = [item for item in session.inventory]
+        for items in session.scene_items.values():
+            places.extend(items)
+        assert len(places) == len(set(places)), 'an item is in two places after the crash'
+
+
+class WalkingGame(Script2Game):
+    # Walks back and forth between two rooms through the game loop, with no
+    # terminal attached, and notes the stack depth and live objects.
+    def __init__(self, world, transitions):
+        super().__init__(world.files, renderer=Renderer())
+        self.rooms = [scene['name'] for scene in world.scenes]
+        self.transitions = transitions
+        self.sent = 0
+        self.depths = set()
+        self.objects = []
+
+    def prompt(self, message):
+        if self.sent == self.transitions:
+            raise EOFError
+        depth = 0
+        frame = sys._getframe()
+        while frame:
+            depth += 1
+            frame = frame.f_back
+        self.depths.add(depth)
+        if self.sent % (self.transitions // 5) == 0:
+            gc.collect()
+            self.objects.append(len(gc.get_objects()))
+        self.sent += 1
+        target = self.rooms[1] if self.current_scene == self.rooms[0].lower() else self.rooms[0]
+        # Both the 'go to' and the bare exit name forms.
+        return f"go to {target}" if self.sent % 2 else target
+
+
+def test_game_loop_keeps_a_constant_stack_depth(tmp_path):
+    world = generate_world(str(tmp_path), scenes=2, seed=1)
+    game = WalkingGame(world, 5000)
+    game.start_game()
+    assert game.sent == 5000
+    assert len(game.depths) == 1
+    assert max(game.objects) - min(game.objects) < 1000
+
+
+def session_cost(directory, scenes):
+    world = generate_world(directory, scenes=scenes, seed=1)
+    engine = Script2Game(world.files, renderer=Renderer())
+    renderer = Renderer()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [engine.new_session(renderer) for _ in range(200)]
+    cost = (tracemalloc.get_traced_memory()[0] - before) / len(sessions)
+    tracemalloc.stop()
+    return cost
+
+
+def test_a_new_session_costs_the_same_in_any_world(tmp_path):
+    small = session_cost(str(tmp_path / 'small'), 10)
+    large = session_cost(str(tmp_path / 'large'), 1000)
+    assert large < small * 1.1 + 64
+
+
+def test_sessions_share_the_rooms_they_did_not_change(tmp_path):
+    world = generate_world(str(tmp_path), scenes=5, seed=1)
+    engine = Script2Game(world.files, renderer=Renderer())
+    first, second = engine.scenes[world.scenes[0]['name'].lower()], engine.scenes[world.scenes[1]['name'].lower()]
+    player = engine.new_session()
+    player.start(world.scenes[0]['name'])
+    player.step(f"take {world.scenes[0]['items'][1][0]}")
+    assert list(player.scene_items) == [first['key']]
+    assert player.get_scene_items(second) is second['content']['Items']
+    assert engine.new_session().get_scene_items(first) is first['content']['Items']
+
+
+def recipes_of(file):
+    engine = Script2Game([file], renderer=Renderer())
+    return sorted((recipe.ingredients, recipe.result, recipe.description) for recipe in engine.recipes)
+
+
+def test_recipes_read_ingredients_before_the_result():
+    # "- A + B = Result: description", as demo.md and GAME/demo.md write them.
+    assert recipes_of('demo.md') == [
+        (('Old Army Revolver', 'Ammo'), 'Loaded Revolver', 'A revolver loaded with ammo'),
+        (('item1', 'item2'), 'item3', None),
+    ]
+    assert recipes_of('GAME/demo.md') == [
+        (('Old Army Revolver', 'Ammo'), 'Loaded Revolver', 'A revolver loaded with ammo'),
+    ]
+
+
+def test_recipes_of_three_ingredients_and_lines_that_are_not_recipes():
+    engine = Script2Game([], renderer=Renderer())
+    recipes = engine.parse_item_combinations(
+        "- Lamp + Oil + Wick = Lit Lamp: Bright\n- Lamp = Lamp\n- Lamp + = Nothing\nLamp + Oil = Not a list item")
+    assert [(recipe.ingredients, recipe.result, recipe.description) for recipe in recipes] == [
+        (('Lamp', 'Oil', 'Wick'), 'Lit Lamp', 'Bright'),
+    ]
+
+
+def test_demo_combination_crafts_the_result():
+    engine = Script2Game(['demo.md'], renderer=Renderer())
+    engine.start()
+    engine.step('take revolver')
+    engine.step('take ammo')
+    assert 'Loaded Revolver' in engine.step('combine revolver + ammo')
+    assert [item.name for item in engine.inventory] == ['Loaded Revolver']
+
+
+def tree(node):
+    return [node.text, [(choice.text, choice.actions, tree(choice.node)) for choice in node.choices]]
+
+
+def test_demo_dialogue_options_nest_by_indentation():
+    engine = Script2Game(['demo.md'], renderer=Renderer())
+    dialogues = engine.scenes['living room']['content']['Dialogues']
+    assert list(dialogues) == ['sherlock holmes']
+    text, choices = tree(dialogues['sherlock holmes'])
+    assert text == 'Sherlock Holmes: Hello, I am Sherlock Holmes.'
+    assert [choice[0] for choice in choices] == ['Ask about the case.', 'Ask about his methods.']
+    case = choices[0][2]
+    assert case[0] == 'Sherlock Holmes: The case is quite intriguing. It involves a mysterious disappearance.'
+    assert [(option, actions) for option, actions, _ in case[1]] == [
+        ('Ask about his methods.', ()),
+        ('(Give Book) Give the book to Sherlock Holmes.', (('give', 'Book'),)),
+        ('(Take Book) Take the book from Sherlock Holmes.', (('take', 'Book'),)),
+    ]
+    assert case[1][2][2] == ['Sherlock Holmes: I need that book for my investigation.', []]
+
+
+def test_game_demo_conversation_is_opened_by_each_of_its_speakers():
+    engine = Script2Game(['GAME/demo.md'], renderer=Renderer())
+    dialogues = engine.scenes['laboratory']['content']['Dialogues']
+    assert list(dialogues) == ['sherlock holmes', 'dr. watson']
+    assert dialogues['sherlock holmes'] is dialogues['dr. watson']
+    assert dialogues['dr. watson'].text.split('\n') == [
+        "Sherlock Holmes: Ah, Watson. I've made some progress. These symbols correspond to elements on the periodic table.",
+        "Dr. Watson: Elements? So, you think the culprit is leaving a message?",
+        "Sherlock Holmes: Exactly. I need to decode this message to find the next location.",
+    ]
+    # "None" under Dialogues is a line no one says.
+    assert dict(engine.scenes['abandoned warehouse district']['content']['Dialogues']) == {}
+
+
+def test_game_demo_study_dialogue_nests_four_space_options():
+    # The study's dialogue follows the global combinations in GAME/demo.md,
+    # so the scene does not pick it up; it is parsed on its own here.
+    with open('GAME/demo.md', encoding='utf-8') as f:
+        text = f.read()
+    start = text.index('### Dialogues\n') + len('### Dialogues\n')
+    body = text[start:text.index('## Scene: Laboratory')]
+    dialogues = Script2Game([], renderer=Renderer()).parse_dialogues(body.strip())
+    assert list(dialogues) == ['dr. watson', 'sherlock holmes']
+    text, choices = tree(dialogues['sherlock holmes'])
+    assert text.startswith('Dr. Watson: What is it this time, Holmes?\nSherlock Holmes: Ah,')
+    assert [(option, actions) for option, actions, _ in choices] == [
+        ('Ask him about the experiment.', (('leave', 'Laboratory'),)),
+        ('Ask him about the symbols.', ()),
+        ('Ask him about the burglaries.', ()),
+    ]
+    burglaries = choices[2][2]
+    assert burglaries[0] == 'Sherlock Holmes: The burglaries have taken place two days ago.'
+    assert [option for option, _, _ in burglaries[1]] == ['What was the crime scene?', 'What was stolen?']
+    assert burglaries[1][0][2][0].split('\n') == [
+        'Sherlock Holmes: It was a commercial building on Trafalgar Square.',
+        'Dr. Watson: Maybe we should take a closer look there, Holmes?',
+    ]
@@ -0,0 +1,147 @@
+import argparse
+import os
+import random
+import sys
+
+
+ADJECTIVES = ('Brass', 'Dusty', 'Cracked', 'Silver', 'Heavy', 'Faded', 'Tiny', 'Gilded', 'Rusty', 'Carved')
+NOUNS = ('Lamp', 'Key', 'Box', 'Map', 'Coin', 'Letter', 'Bottle', 'Ring', 'Candle', 'Compass')
+PLACES = ('Hall', 'Cellar', 'Library', 'Garden', 'Attic', 'Study', 'Gallery', 'Kitchen', 'Chapel', 'Vault')
+ROLES = ('Keeper', 'Guard', 'Scholar', 'Merchant', 'Gardener', 'Cook', 'Priest', 'Clerk')
+
+
+class GeneratedWorld:
+    # What generate_world() wrote, so benchmarks can build valid commands
+    # without parsing the files: per scene its name, exits, items (with what
+    # each contains), characters and the speaker of its dialogue.
+    def __init__(self, files, scenes, recipes):
+        self.files = files
+        self.scenes = scenes
+        self.recipes = recipes
+
+
+def generate_world(directory, scenes=100, files=1, exits=2, items=3, containers=1, fixed=0, characters=1,
+                   dialogue_depth=2, dialogue_branching=2, combinations=10, seed=0):
+    # Writes a valid script2game world of the given shape into directory.
+    # The same arguments always produce the same files. Scene i always has an
+    # exit to scene i + 1, so every scene is reachable from the first; the
+    # other exits are random. containers of the items hold a nested item,
+    # fixed of them cannot be taken. The first character of each scene has a
+    # dialogue tree dialogue_depth deep with dialogue_branching options per
+    # node. Recipes combine two or three items found somewhere in the world.
+    rng = random.Random(seed)
+    names = [f"{PLACES[i % len(PLACES)]} {i}" for i in range(scenes)]
+    layout = []
+    every_item = []
+    for i, name in enumerate(names):
+        targets = [names[(i + 1) % scenes]] if scenes > 1 else []
+        while len(targets) < min(exits, scenes - 1):
+            target = names[rng.randrange(scenes)]
+            if target != name and target not in targets:
+                targets.append(target)
+        scene_items = []
+        for j in range(items):
+            item = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i}-{j}"
+            nested = f"Hidden Note {i}-{j}" if j < containers else None
+            scene_items.append((item, nested, j >= items - fixed))
+            if j < items - fixed:
+                every_item.append(item)
+        people = [f"{ROLES[(i + k) % len(ROLES)]} {i}-{k}" for k in range(characters)]
+        layout.append({'name': name, 'exits': targets, 'items': scene_items, 'characters': people,
+                       'speaker': people[0] if people else None})
+
+    recipes = []
+    for k in range(combinations if len(every_item) >= 2 else 0):
+        ingredients = rng.sample(every_item, min(len(every_item), rng.randint(2, 3)))
+        recipes.append((ingredients, f"Contraption {k}"))
+    return write_world(directory, layout, recipes, files, dialogue_depth, dialogue_branching, rng)
+
+
+def write_world(directory, layout, recipes=(), files=1, dialogue_depth=2, dialogue_branching=2, rng=None):
+    # Writes scenes laid out the way generate_world() lays them out (a list
+    # of dicts with name, exits, items, characters and speaker) and recipes
+    # as (ingredients, result) pairs, for worlds of a shape generate_world()
+    # does not make. Exits may lead to scenes that are not in layout.
+    rng = rng or random.Random(0)
+    os.makedirs(directory, exist_ok=True)
+    names = [scene['name'] for scene in layout]
+    scenes = len(layout)
+    paths = []
+    per_file = -(-scenes // files) if scenes else 0
+    for file_id in range(files):
+        path = os.path.join(directory, f"world_{file_id:04d}.md")
+        with open(path, 'w', encoding='utf-8') as f:
+            for i in range(file_id * per_file, min(scenes, (file_id + 1) * per_file)):
+                write_scene(f, layout[i], rng, names, dialogue_depth, dialogue_branching)
+            if file_id == files - 1 and recipes:
+                f.write("## Global Item Combinations\n")
+                for ingredients, result in recipes:
+                    f.write(f"- {' + '.join(ingredients)} = {result}: Made from {len(ingredients)} things\n")
+        paths.append(path)
+    return GeneratedWorld(paths, layout, list(recipes))
+
+
+def write_scene(f, scene, rng, names, depth, branching):
+    f.write(f"## Scene: {scene['name']}\n\n### Description\n\n")
+    f.write(f"The {scene['name'].split()[0].lower()} smells of dust and old paper.\n\n")
+    if scene['items']:
+        f.write("### Items\n\n")
+        for item, nested, is_fixed in scene['items']:
+            f.write(f"- {item}{' (X)' if is_fixed else ''}\n")
+            if nested:
+                f.write(f"#### {nested}\n")
+        f.write("\n")
+    if scene['characters']:
+        f.write("### Characters\n\n")
+        for person in scene['characters']:
+            f.write(f"{person}: is waiting for someone.\n")
+        f.write("\n")
+    if scene['exits']:
+        f.write("### Exits\n\n")
+        for exit in scene['exits']:
+            f.write(f"- {exit}\n")
+        f.write("\n")
+    if scene['speaker']:
+        f.write("### Dialogues\n\n")
+        f.write(f"{scene['speaker']}: What brings you to the {scene['name']}?\n")
+        write_options(f, rng, names, depth, branching, '')
+        f.write("\n")
+
+
+def write_options(f, rng, names, depth, branching, indent):
+    if not depth:
+        return
+    for option in range(1, branching + 1):
+        if depth == 1 and option == branching and rng.random() < 0.5:
+            target = rng.choice(names)
+            f.write(f"{indent}{option}. Ask the way to the {target}.\n")
+            f.write(f"{indent}   Follow me. (Leaves to the {target})\n")
+            continue
+        f.write(f"{indent}{option}. Ask about rumour {option}.\n")
+        f.write(f"{indent}   Rumour {option} is older than the house itself.\n")
+        write_options(f, rng, names, depth - 1, branching, indent + '   ')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='write a synthetic script2game world')
+    parser.add_argument('directory')
+    parser.add_argument('--scenes', type=int, default=100)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--exits', type=int, default=2, help='exits per scene')
+    parser.add_argument('--items', type=int, default=3, help='items per scene')
+    parser.add_argument('--containers', type=int, default=1, help='items per scene holding a nested item')
+    parser.add_argument('--fixed', type=int, default=0, help='items per scene that cannot be taken')
+    parser.add_argument('--characters', type=int, default=1, help='characters per scene')
+    parser.add_argument('--dialogue-depth', type=int, default=2)
+    parser.add_argument('--dialogue-branching', type=int, default=2)
+    parser.add_argument('--combinations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    world = generate_world(args.directory, args.scenes, args.files, args.exits, args.items, args.containers, args.fixed,
+                           args.characters, args.dialogue_depth, args.dialogue_branching, args.combinations, args.seed)
+    print(f"Wrote {len(world.scenes)} scenes and {len(world.recipes)} recipes to {len(world.files)} file(s) in {args.directory}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())